@@ -1,12 +1,17 @@
 import asyncio
 import logging
+import os
 from pathlib import Path
 from pprint import pprint
 
-from quart import Quart, request, jsonify, send_from_directory
+from quart import Quart, request, jsonify, send_file, send_from_directory
+from schema import SchemaError
 
 import lib_app_config
 import lib_net_ctx
+from lib_node_jobs import NODE_NAME
+from lib_package_mirror import RETRY_INTERVAL, PackageUnavailable
+from lib_util import try_read_json
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -16,12 +21,14 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 app_config = lib_app_config.AppConfig(
-    {
-        'data_dir': './data',
-        'gcp_credentials_file': './tomassvc.google-service-account.json',
-        'initial_delay': 10,
-        'check_interval': 10,
-    }
+    try_read_json(
+        os.environ.get('APP_CONFIG_FILE', ''), {
+            'data_dir': './data',
+            'gcp_credentials_file': './tomassvc.google-service-account.json',
+            'initial_delay': 10,
+            'check_interval': 10,
+        }
+    )
 )
 net_ctx = lib_net_ctx.NetworkContext(app_config)
 
@@ -36,23 +43,82 @@ async def init():
 @app.route('/nodes/<node_name>', methods=['PUT'])
 async def api_node_put(node_name):
     config = await request.get_json()
-    if node in net_ctx.nodes:
-        node = net_ctx.nodes[node_name]
+    if not NODE_NAME.match(node_name) or not isinstance(config, dict):
+        return '', 400
+    node = net_ctx.nodes.get(node_name)
+    if node:
+        if node.loading:
+            return '', 409
+        await net_ctx.update_node(node, config)
+        node.try_start_async()
     else:
-        net_ctx.create_node(node_name, config)
+        await net_ctx.create_node(node_name, config)
     return '', 200
 
 
+@app.route('/nodes', methods=['POST'])
+async def api_nodes_post():
+    try:
+        job = net_ctx.jobs.submit(await request.get_json())
+    except SchemaError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'job': job.id}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def api_job(job_id):
+    job = net_ctx.jobs.get(job_id)
+    if not job:
+        return '', 404
+    return jsonify(job.status())
+
+
 @app.route('/heartbeat/<node_name>', methods=['POST'])
 async def api_heartbeat(node_name):
     try:
         msg = await request.get_json()
-        reply = net_ctx.nodes[node_name].heartbeat(msg or {})
-        return jsonify(reply)
+        node = net_ctx.nodes[node_name]
     except KeyError:
         return '', 404
+    # ?wait=<seconds> holds the request until the reply changes
+    wait = request.args.get('wait', type=float)
+    if wait:
+        wait = min(wait, app_config.heartbeat_max_wait)
+        reply = await node.heartbeat_wait(msg or {}, wait)
+    else:
+        reply = node.heartbeat(msg or {})
+    return jsonify(reply)
+
+@app.route('/stats', methods=['GET'])
+async def api_stats():
+    return jsonify(net_ctx.stats())
+
 
 @app.route('/files/<node_name>/<path:filename>', methods=['GET'])
 async def api_files(node_name, filename):
     root = Path(app_config.nodes_data_dir) / node_name / 'files'
     return await send_from_directory(root, filename)
+
+
+@app.route('/packages/<key>/<filename>', methods=['GET'])
+async def api_package(key, filename):
+    try:
+        package = await net_ctx.packages.get(key)
+    except PackageUnavailable:
+        return '', 503, {'Retry-After': str(RETRY_INTERVAL)}
+    if not package:
+        return '', 404
+    path, sha256 = package
+    # Same .hash side file as the build server, see misc/bootstrap.bash
+    if filename.endswith('.hash'):
+        return sha256, 200, {'Content-Type': 'text/plain'}
+    response = await send_file(
+        path, mimetype='application/octet-stream', add_etags=False
+    )
+    # The content hash makes a strong ETag
+    response.set_etag(sha256)
+    response.accept_ranges = 'bytes'
+    await response.make_conditional(
+        request, accept_ranges=True, complete_length=path.stat().st_size
+    )
+    return response
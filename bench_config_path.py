@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Compares lib_config's path helpers with the pyjq-based versions they
+# replaced, on the paths NodeContext.load_config_full fills in. Checks
+# that both produce the same configs first. Needs pyjq installed.
+#
+#   ./bench_config_path.py --loads 1000
+
+import argparse
+import copy
+import time
+
+import pyjq
+
+import lib_config
+
+PATHS = [
+    '.rnode_conf.casper."validator-private-key"',
+    '.rnode_tls_key',
+    '.rnode_id',
+    '.resources_name',
+    '.hostname',
+    '.rnode_addr',
+]
+
+
+def jq_add_missing_value(config, path, value):
+    if pyjq.first(path, config) == None:
+        v = value() if callable(value) else value
+        config = pyjq.first(path + '=$v', config, vars={'v': v})
+    return config
+
+
+def jq_add_missing_value_aux(config, config_aux, path, value):
+    get_script = pyjq.compile(path)
+    if get_script.first(config) == None:
+        aux_val = get_script.first(config_aux)
+        if aux_val != None:
+            v = aux_val
+        else:
+            v = value() if callable(value) else value
+        set_script = pyjq.compile(path + '=$v', vars={'v': v})
+        config = set_script.first(config)
+        if aux_val == None:
+            config_aux = set_script.first(config_aux)
+    return config, config_aux
+
+
+def sample_config():
+    return {
+        'rnode_conf': {
+            'server': {
+                'port': 40400,
+                'port-kademlia': 40404
+            },
+            'casper': {
+                'validators': 10
+            },
+        },
+        'hostname_suffix': '.nodes.example.',
+        'resources_name_prefix': 'node-',
+        'templates': ['default'],
+    }
+
+
+def load(add_missing_value, add_missing_value_aux, config, config_aux):
+    for path in PATHS[:2]:
+        config, config_aux = add_missing_value_aux(
+            config, config_aux, path, 'value-' + path
+        )
+    for path in PATHS[2:]:
+        config = add_missing_value(config, path, lambda: 'value-' + path)
+    return config, config_aux
+
+
+def check():
+    cases = [
+        (sample_config(), {}),
+        (sample_config(), {'rnode_tls_key': 'aux-key'}),
+        ({'rnode_id': 'set', 'rnode_conf': None}, {}),
+        ({}, {'rnode_conf': {'casper': {'validator-private-key': 'aux'}}}),
+    ]
+    for config, config_aux in cases:
+        before = copy.deepcopy((config, config_aux))
+        expected = load(
+            jq_add_missing_value, jq_add_missing_value_aux, config, config_aux
+        )
+        got = load(
+            lib_config.add_missing_value, lib_config.add_missing_value_aux,
+            config, config_aux
+        )
+        assert got == expected, (got, expected)
+        assert (config, config_aux) == before, 'inputs were modified'
+    for path in ['.rnode_conf.server', '.x', '.rnode_conf."port"']:
+        expected = pyjq.first(path, sample_config())
+        assert lib_config.config_path(path).get(sample_config()) == expected
+
+
+def bench(name, add_missing_value, add_missing_value_aux, loads):
+    ts = time.perf_counter()
+    for _ in range(loads):
+        load(add_missing_value, add_missing_value_aux, sample_config(), {})
+    elapsed = time.perf_counter() - ts
+    print(
+        '%-10s %8.3fs %10.1f us/load' %
+        (name, elapsed, elapsed / loads * 1e6)
+    )
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loads', type=int, default=1000)
+    args = parser.parse_args()
+
+    check()
+    jq = bench(
+        'pyjq', jq_add_missing_value, jq_add_missing_value_aux, args.loads
+    )
+    native = bench(
+        'lib_config', lib_config.add_missing_value,
+        lib_config.add_missing_value_aux, args.loads
+    )
+    print('speedup    %8.1fx' % (jq / native))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Heartbeat throughput benchmark. Runs the controller in-process with the
+# fake host backend and N simulated hosts posting to /heartbeat through
+# the Quart test client. Each node count runs in its own process so that
+# memory figures do not carry over.
+#
+#   ./bench_heartbeat.py 100 1000 10000
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from lib_util import read_json, write_json
+
+TEMPLATE = Path(__file__).resolve().parent / 'data/templates/default.json'
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def prepare(root, args):
+    credentials = root / 'credentials.json'
+    credentials.write_text('{}')
+    write_json(
+        root / 'app.json', {
+            'data_dir': str(root / 'data'),
+            'gcp_credentials_file': str(credentials),
+            'host_backend': 'fake',
+            'fake_host_latency': args.host_latency,
+            'fake_host_failure_rate': args.host_failure_rate,
+            'initial_delay': 0,
+            'check_interval': args.check_interval,
+        }
+    )
+
+    # Full configs are written directly, skipping key generation, which
+    # is not what is being measured here
+    template = read_json(TEMPLATE)
+    for i in range(args.nodes):
+        name = 'node%d' % i
+        node_dir = root / 'data/nodes' / name
+        os.makedirs(node_dir)
+        hostname = name + template['hostname_suffix']
+        write_json(
+            node_dir / 'config.full.json',
+            dict(
+                template,
+                resources_name=template['resources_name_prefix'] + name,
+                hostname=hostname,
+                rnode_id='%040x' % i,
+                rnode_addr='rnode://%040x@%s?protocol=40400&discovery=40404'
+                % (i, hostname),
+                timeout_heartbeat=args.interval * 10,
+            ),
+        )
+
+
+async def measure_lag(samples, period=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        ts = loop.time()
+        await asyncio.sleep(period)
+        samples.append(loop.time() - ts - period)
+
+
+async def simulate_host(client, name, args, latencies, errors, ts_end):
+    msg = {'genesis': 'A'}
+    await asyncio.sleep(random.uniform(0, args.interval))
+    while time.time() < ts_end:
+        ts = time.perf_counter()
+        response = await client.post('/heartbeat/' + name, json=msg)
+        latencies.append(time.perf_counter() - ts)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+        else:
+            reply = await response.get_json()
+            if reply and not reply.get('unchanged'):
+                msg['version'] = reply['version']
+                msg['cookie_exec'] = str(reply['cookie_exec'])
+                msg['cookie_data'] = str(reply['cookie_data'])
+        await asyncio.sleep(args.interval)
+
+
+async def run_child(args):
+    root = Path(tempfile.mkdtemp(prefix='bench-heartbeat-'))
+    prepare(root, args)
+    os.environ['APP_CONFIG_FILE'] = str(root / 'app.json')
+
+    import app
+    logging.disable(logging.WARNING)
+    net_ctx = app.net_ctx
+
+    majority_times = []
+    pick_majority = net_ctx.pick_majority
+
+    def timed_pick_majority():
+        ts = time.perf_counter()
+        pick_majority()
+        majority_times.append(time.perf_counter() - ts)
+
+    net_ctx.pick_majority = timed_pick_majority
+
+    async with app.app.test_app() as test_app:
+        client = test_app.test_client()
+        ts_begin = time.time()
+        while len(net_ctx.nodes) < args.nodes or any(
+            node.loading or node.maintenance_lock.locked()
+            for node in net_ctx.nodes.values()
+        ):
+            await asyncio.sleep(0.1)
+        ts_started = time.time()
+
+        latencies = []
+        errors = []
+        lag = []
+        lag_task = asyncio.create_task(measure_lag(lag))
+        ts_end = time.time() + args.duration
+        await asyncio.gather(
+            *(
+                simulate_host(client, name, args, latencies, errors, ts_end)
+                for name in list(net_ctx.nodes)
+            )
+        )
+        lag_task.cancel()
+    shutil.rmtree(root)
+
+    return {
+        'nodes': args.nodes,
+        'startup': ts_started - ts_begin,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / args.duration,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies, default=0),
+        'lag_p99': percentile(lag, 99),
+        'lag_max': max(lag, default=0),
+        'pick_majority_max': max(majority_times, default=0),
+        'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+COLUMNS = [
+    ('nodes', '%7d'),
+    ('startup', '%8.2fs'),
+    ('rps', '%9.1f'),
+    ('errors', '%7d'),
+    ('latency_p50', '%9.2fms'),
+    ('latency_p99', '%9.2fms'),
+    ('latency_max', '%9.2fms'),
+    ('lag_p99', '%9.2fms'),
+    ('lag_max', '%9.2fms'),
+    ('pick_majority_max', '%9.2fms'),
+    ('maxrss_mb', '%8.1fMB'),
+]
+
+
+def print_row(result):
+    cells = []
+    for key, fmt in COLUMNS:
+        value = result[key]
+        if fmt.endswith('ms'):
+            value *= 1000
+        cells.append(fmt % value)
+    print(' '.join(cells), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('nodes', type=int, nargs='*', default=[100, 1000])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--check-interval', type=int, default=1)
+    parser.add_argument('--host-latency', type=float, default=0)
+    parser.add_argument('--host-failure-rate', type=float, default=0)
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.nodes = args.nodes[0]
+        print(json.dumps(asyncio.run(run_child(args))))
+        return
+
+    if not args.json:
+        print(' '.join(key for key, _ in COLUMNS), flush=True)
+    for nodes in args.nodes:
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--child', str(nodes)] + [
+                '--duration', str(args.duration),
+                '--interval', str(args.interval),
+                '--check-interval', str(args.check_interval),
+                '--host-latency', str(args.host_latency),
+                '--host-failure-rate', str(args.host_failure_rate),
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+        result = json.loads(output.splitlines()[-1])
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            print_row(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,11 @@ import os.path
 import shutil
 from pathlib import Path
 
-from schema import Schema, Use, Optional as Opt
+from schema import Schema, SchemaError, And, Or, Regex, Use, Optional as Opt
 
 from lib_config import (
-    ConfigDict, NonEmptyStr, PositiveNum, OptEnv, add_missing_value
+    ConfigDict, NonEmptyStr, NonZeroNum, PositiveFloat, PositiveNum, OptEnv,
+    add_missing_value
 )
 from lib_util import read_json
 
@@ -15,7 +16,33 @@ SCHEMA = Schema(
         'data_dir': NonEmptyStr,
         OptEnv('gcp_credentials_file', ' GOOGLE_APPLICATION_CREDENTIALS'): os.path.isfile,
         Opt('initial_delay'): PositiveNum,
-        Opt('check_interval'): PositiveNum
+        Opt('check_interval'): PositiveNum,
+        Opt('gcp_connection_pool_size'): NonZeroNum,
+        Opt('startup_workers'): PositiveNum,
+        Opt('gcp_compute_rate'): NonZeroNum,
+        Opt('gcp_dns_rate'): NonZeroNum,
+        Opt('gcp_max_retries'): PositiveNum,
+        Opt('restart_max_unavailable'): Or(
+            PositiveNum, Regex(r'^\d+(\.\d+)?%$')
+        ),
+        Opt('standby_pool_size'): PositiveNum,
+        Opt('standby_template'): NonEmptyStr,
+        Opt('standby_warmup'): PositiveNum,
+        Opt('decision_debounce'): PositiveFloat,
+        Opt('heartbeat_max_wait'): PositiveNum,
+        Opt('warm_start_delay'): PositiveNum,
+        Opt('template_poll_interval'): PositiveNum,
+        Opt('host_backend'): Or('gcp', 'fake'),
+        Opt('fake_host_latency'): PositiveFloat,
+        Opt('fake_host_failure_rate'): And(Use(float), lambda f: 0 <= f <= 1),
+        Opt('gcp_operation_poll_interval'): NonZeroNum,
+        Opt('dns_batch_window'): PositiveNum,
+        Opt('dns_batch_max'): PositiveNum,
+        Opt('package_mirror_url'): NonEmptyStr,
+        Opt('key_pool_size'): PositiveNum,
+        Opt('key_pool_low_water'): PositiveNum,
+        Opt('key_pool_workers'): NonZeroNum,
+        Opt('key_pool_secret_file'): NonEmptyStr,
     }
 )
 
@@ -24,6 +51,10 @@ class AppConfig:
     def __init__(self, data):
         data = copy.deepcopy(data)
         self.data = SCHEMA.validate(data)
+        if self.key_pool_size and not self.key_pool_secret_file:
+            raise SchemaError(
+                'key_pool_secret_file is required when key_pool_size is set'
+            )
 
     def _get(self, key, default):
         try:
@@ -68,3 +99,106 @@ class AppConfig:
     @property
     def check_interval(self) -> int:
         return self._get('check_interval', 120)
+
+    @property
+    def gcp_connection_pool_size(self) -> int:
+        return self._get('gcp_connection_pool_size', 10)
+
+    @property
+    def startup_workers(self) -> int:
+        return self._get('startup_workers', 8)
+
+    @property
+    def gcp_compute_rate(self) -> int:
+        return self._get('gcp_compute_rate', 10)
+
+    @property
+    def gcp_dns_rate(self) -> int:
+        return self._get('gcp_dns_rate', 5)
+
+    @property
+    def gcp_max_retries(self) -> int:
+        return self._get('gcp_max_retries', 5)
+
+    @property
+    def restart_max_unavailable(self):
+        return self._get('restart_max_unavailable', '10%')
+
+    @property
+    def standby_pool_size(self) -> int:
+        return self._get('standby_pool_size', 0)
+
+    @property
+    def standby_template(self) -> str:
+        return self._get('standby_template', 'default')
+
+    @property
+    def standby_warmup(self) -> int:
+        return self._get('standby_warmup', 300)
+
+    @property
+    def decision_debounce(self) -> float:
+        return self._get('decision_debounce', 1)
+
+    @property
+    def heartbeat_max_wait(self) -> int:
+        return self._get('heartbeat_max_wait', 60)
+
+    @property
+    def warm_start_delay(self) -> int:
+        return self._get('warm_start_delay', 15)
+
+    @property
+    def template_poll_interval(self) -> int:
+        return self._get('template_poll_interval', 10)
+
+    @property
+    def host_backend(self) -> str:
+        return self._get('host_backend', 'gcp')
+
+    @property
+    def fake_host_latency(self) -> float:
+        return self._get('fake_host_latency', 0)
+
+    @property
+    def fake_host_failure_rate(self) -> float:
+        return self._get('fake_host_failure_rate', 0)
+
+    @property
+    def gcp_operation_poll_interval(self) -> int:
+        return self._get('gcp_operation_poll_interval', 2)
+
+    @property
+    def dns_batch_window(self) -> float:
+        return self._get('dns_batch_window', 1)
+
+    @property
+    def dns_batch_max(self) -> int:
+        return self._get('dns_batch_max', 100)
+
+    @property
+    def key_pool_size(self) -> int:
+        return self._get('key_pool_size', 0)
+
+    @property
+    def key_pool_low_water(self) -> int:
+        return self._get('key_pool_low_water', 10)
+
+    @property
+    def key_pool_workers(self) -> int:
+        return self._get('key_pool_workers', 2)
+
+    @property
+    def key_pool_secret_file(self) -> str:
+        # Never defaults to data_dir, a copy of it together with the pool
+        # would give away every pooled key. Point it at a secret mount,
+        # either here or with KEY_POOL_SECRET_FILE.
+        path = self._get(
+            'key_pool_secret_file',
+            lambda: os.environ.get('KEY_POOL_SECRET_FILE'),
+        )
+        return path and os.path.abspath(path)
+
+    @property
+    def package_mirror_url(self):
+        return self._get('package_mirror_url', None)
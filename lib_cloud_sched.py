@@ -0,0 +1,181 @@
+import enum
+import functools
+import heapq
+import itertools
+import logging
+import random
+import time
+from asyncio import get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+from libcloud.common.exceptions import RateLimitReachedError
+
+CallPriority = enum.IntEnum(
+    'CallPriority', 'LEADER RECOVERY NORMAL BACKGROUND'
+)
+
+RETRY_CODES = {
+    'rateLimitExceeded',
+    'userRateLimitExceeded',
+    'RATE_LIMIT_EXCEEDED',
+    'backendError',
+    'internalError',
+}
+
+
+def is_retryable(e):
+    if isinstance(e, RateLimitReachedError):
+        return True
+    http_code = getattr(e, 'http_code', None)
+    if http_code == 429 or (isinstance(http_code, int) and http_code >= 500):
+        return True
+    return getattr(e, 'code', None) in RETRY_CODES
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.ts) * self.rate
+        )
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ClassStats:
+    def __init__(self):
+        self.queued = 0
+        self.dispatched = 0
+        self.retries = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def as_dict(self):
+        return {
+            'queued': self.queued,
+            'dispatched': self.dispatched,
+            'retries': self.retries,
+            'wait_avg': (
+                self.wait_total / self.dispatched if self.dispatched else 0
+            ),
+            'wait_max': self.wait_max,
+        }
+
+
+class _Family:
+    def __init__(self, name, workers, rate):
+        self.name = name
+        self.workers = workers
+        self.busy = 0
+        self.bucket = TokenBucket(rate, max(rate, 1))
+        self.waiters = []
+        self.wakeup = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='cloud-' + name
+        )
+        self.stats = {p: ClassStats() for p in CallPriority}
+
+
+class CloudScheduler:
+    def __init__(self, workers, rates, max_retries=5, backoff=1.0):
+        self._families = {
+            name: _Family(name, workers, rate)
+            for name, rate in rates.items()
+        }
+        self._seq = itertools.count()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.log = logging.getLogger(__name__)
+
+    def _kick(self, family):
+        family.wakeup = None
+        while family.waiters and family.busy < family.workers:
+            priority, _, ts, fut = family.waiters[0]
+            if fut.done():
+                heapq.heappop(family.waiters)
+                continue
+            delay = family.bucket.take()
+            if delay:
+                family.wakeup = get_running_loop().call_later(
+                    delay, self._kick, family
+                )
+                return
+            heapq.heappop(family.waiters)
+            family.busy += 1
+            stats = family.stats[priority]
+            stats.queued -= 1
+            stats.dispatched += 1
+            wait = time.monotonic() - ts
+            stats.wait_total += wait
+            stats.wait_max = max(stats.wait_max, wait)
+            fut.set_result(None)
+
+    async def _acquire(self, family, priority):
+        fut = get_running_loop().create_future()
+        heapq.heappush(
+            family.waiters,
+            (priority, next(self._seq), time.monotonic(), fut),
+        )
+        family.stats[priority].queued += 1
+        if not family.wakeup:
+            self._kick(family)
+        try:
+            await fut
+        except:
+            if not fut.done() or fut.cancelled():
+                family.stats[priority].queued -= 1
+            else:
+                self._release(family)
+            raise
+
+    def _release(self, family):
+        family.busy -= 1
+        if not family.wakeup:
+            self._kick(family)
+
+    async def call(self, family_name, priority, func, *args, **kwargs):
+        family = self._families[family_name]
+        no_args_func = functools.partial(func, *args, **kwargs)
+        attempt = 0
+        while True:
+            await self._acquire(family, priority)
+            try:
+                return await get_running_loop().run_in_executor(
+                    family.executor, no_args_func
+                )
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+                self.log.warning(
+                    'Retrying %s in %.1fs after error: %s',
+                    getattr(func, '__name__', func), delay, e
+                )
+                family.stats[priority].retries += 1
+            finally:
+                self._release(family)
+            attempt += 1
+            await sleep(delay)
+
+    def stats(self):
+        return {
+            name: {
+                'busy': family.busy,
+                'workers': family.workers,
+                'classes': {
+                    p.name: family.stats[p].as_dict()
+                    for p in CallPriority
+                },
+            }
+            for name, family in self._families.items()
+        }
@@ -1,33 +1,94 @@
+import functools
+import json
 import os
 import os.path
+import re
 from pathlib import Path
 
-import pyjq
 from schema import Schema, And, Use, Optional as Opt
 
 NonEmptyStr = And(str, len)
 ConfigDict = {Opt(str): object}
-PositiveNum = Use(int, lambda i: i >= 0)
+PositiveNum = And(Use(int), lambda i: i >= 0)
+# For rates and sizes that are divided by or must allow at least one
+NonZeroNum = And(Use(int), lambda i: i > 0)
+PositiveFloat = And(Use(float), lambda f: f >= 0)
 OptEnv = lambda name, env_name: Opt(name, default=lambda: os.environ[env_name])
 
+_PATH_SEGMENT = re.compile(
+    r'\.(?:([A-Za-z_][A-Za-z0-9_]*)|("(?:[^"\\]|\\.)*"))'
+)
+
+
+class ConfigPathError(ValueError):
+    pass
+
+
+class ConfigPath:
+    # Subset of jq paths: .key and ."quoted key" segments
+    def __init__(self, path):
+        self.path = path
+        self.keys = []
+        pos = 0
+        while pos < len(path):
+            m = _PATH_SEGMENT.match(path, pos)
+            if not m:
+                raise ConfigPathError(f'Unsupported path "{path}"')
+            self.keys.append(m.group(1) or json.loads(m.group(2)))
+            pos = m.end()
+        if not self.keys:
+            raise ConfigPathError(f'Unsupported path "{path}"')
+
+    def _check(self, obj, key):
+        if obj is not None and not isinstance(obj, dict):
+            raise ConfigPathError(
+                f'Cannot index {type(obj).__name__} with "{key}"'
+            )
+
+    def get(self, obj):
+        for key in self.keys:
+            self._check(obj, key)
+            if obj is None:
+                return None
+            obj = obj.get(key)
+        return obj
+
+    def set(self, obj, value):
+        # Like jq, returns an updated copy and leaves obj untouched; only
+        # the dicts along the path are copied
+        root = obj = self._copy(obj, self.keys[0])
+        for key in self.keys[:-1]:
+            obj[key] = obj = self._copy(obj.get(key), key)
+        obj[self.keys[-1]] = value
+        return root
+
+    def _copy(self, obj, key):
+        self._check(obj, key)
+        return dict(obj) if obj is not None else {}
+
+
+@functools.lru_cache(maxsize=None)
+def config_path(path):
+    return ConfigPath(path)
+
 
 def add_missing_value(config, path, value):
-    if pyjq.first(path, config) == None:
+    path = config_path(path)
+    if path.get(config) == None:
         v = value() if callable(value) else value
-        config = pyjq.first(path + '=$v', config, vars={'v': v})
+        config = path.set(config, v)
     return config
 
 
 def add_missing_value_aux(config, config_aux, path, value):
-    get_script = pyjq.compile(path)
-    if get_script.first(config) == None:
-        aux_val = get_script.first(config_aux)
+    path = config_path(path)
+    if path.get(config) == None:
+        aux_val = path.get(config_aux)
         if aux_val != None:
             v = aux_val
         else:
             v = value() if callable(value) else value
-        set_script = pyjq.compile(path + '=$v', vars={'v': v})
-        config = set_script.first(config)
+        config = path.set(config, v)
         if aux_val == None:
-            config_aux = set_script.first(config_aux)
+            config_aux = path.set(config_aux, v)
     return config, config_aux
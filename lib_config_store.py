@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class ConfigStore:
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self.files_written = 0
+        self.bytes_written = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+
+    def _current_hash(self, path):
+        with self._lock:
+            if path in self._hashes:
+                return self._hashes[path]
+        try:
+            return hashlib.sha256(path.read_bytes()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def _write_atomic(self, path, data):
+        tmp_path = path.with_name('.' + path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def write_bytes(self, path, data):
+        path = Path(path)
+        digest = hashlib.sha256(data).hexdigest()
+        if self._current_hash(path) == digest:
+            with self._lock:
+                self._hashes[path] = digest
+                self.files_skipped += 1
+                self.bytes_skipped += len(data)
+            return False
+        self._write_atomic(path, data)
+        with self._lock:
+            self._hashes[path] = digest
+            self.files_written += 1
+            self.bytes_written += len(data)
+        return True
+
+    def write_text(self, path, text):
+        return self.write_bytes(path, text.encode())
+
+    def write_json(self, path, obj):
+        # Same layout as lib_util.write_json
+        return self.write_text(
+            path, json.dumps(obj, sort_keys=True, indent=4)
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files_written': self.files_written,
+                'bytes_written': self.bytes_written,
+                'files_skipped': self.files_skipped,
+                'bytes_skipped': self.bytes_skipped,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_config_store():
+    global _store
+    with _store_lock:
+        if not _store:
+            _store = ConfigStore()
+        return _store
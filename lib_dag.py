@@ -0,0 +1,68 @@
+import time
+from asyncio import create_task, gather
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List
+
+
+@dataclass
+class Step:
+    name: str
+    deps: List[str]
+    func: Callable[..., Awaitable]
+
+
+@dataclass
+class StepTiming:
+    ts_begin: float
+    ts_end: float
+    deps: List[str] = field(default_factory=list)
+
+    @property
+    def duration(self):
+        return self.ts_end - self.ts_begin
+
+
+def critical_path(timings):
+    if not timings:
+        return []
+    name = max(timings, key=lambda n: timings[n].ts_end)
+    path = [name]
+    while timings[name].deps:
+        name = max(timings[name].deps, key=lambda n: timings[n].ts_end)
+        path.append(name)
+    return path[::-1]
+
+
+async def run_dag(steps, log=None):
+    # Steps must be listed after their dependencies. Each step is called
+    # with the results of its dependencies, in order.
+    tasks = {}
+    timings = {}
+
+    async def run_step(step):
+        args = await gather(*(tasks[dep] for dep in step.deps))
+        ts_begin = time.time()
+        result = await step.func(*args)
+        timings[step.name] = StepTiming(ts_begin, time.time(), step.deps)
+        return result
+
+    for step in steps:
+        tasks[step.name] = create_task(run_step(step))
+    try:
+        await gather(*tasks.values())
+    except:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    finally:
+        if log and timings:
+            for name, t in timings.items():
+                log.info('Step %s took %.3fs', name, t.duration)
+            log.info(
+                'Critical path: %s', ' -> '.join(
+                    '%s (%.3fs)' % (name, timings[name].duration)
+                    for name in critical_path(timings)
+                )
+            )
+
+    return timings
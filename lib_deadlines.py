@@ -0,0 +1,88 @@
+import heapq
+import itertools
+import time
+from asyncio import Event, TimeoutError, wait_for
+
+
+class DeadlineHeap:
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        # Earliest heap entry of each key that is still acted on
+        self._queued = {}
+        self._seq = itertools.count()
+        self._changed = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _push(self, key, ts):
+        self._queued[key] = ts
+        heapq.heappush(self._heap, (ts, next(self._seq), key))
+
+    def _rebuild(self):
+        self._heap = [
+            (ts, next(self._seq), key) for key, ts in self._deadlines.items()
+        ]
+        heapq.heapify(self._heap)
+        self._queued = dict(self._deadlines)
+
+    def arm(self, key, ts):
+        if ts is None:
+            self._deadlines.pop(key, None)
+            return
+        if self._deadlines.get(key) == ts:
+            return
+        self._deadlines[key] = ts
+        # Heartbeats only push deadlines back, the entry already queued
+        # moves itself once it comes up
+        queued = self._queued.get(key)
+        if queued is not None and queued <= ts:
+            return
+        self._push(key, ts)
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._rebuild()
+        if self._changed and self._heap[0][2] is key:
+            self._changed.set()
+
+    def _prune(self):
+        while self._heap:
+            ts, _, key = self._heap[0]
+            if self._queued.get(key) != ts:
+                heapq.heappop(self._heap)
+                continue
+            deadline = self._deadlines.get(key)
+            if deadline == ts:
+                break
+            heapq.heappop(self._heap)
+            if deadline is None:
+                del self._queued[key]
+            else:
+                self._push(key, deadline)
+
+    def next_deadline(self):
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        due = []
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            del self._queued[key]
+            due.append(key)
+            self._prune()
+        return due
+
+    async def wait(self, until):
+        if not self._changed:
+            self._changed = Event()
+        self._changed.clear()
+        deadline = self.next_deadline()
+        if deadline is not None:
+            until = min(until, deadline)
+        try:
+            await wait_for(self._changed.wait(), max(0, until - time.time()))
+        except TimeoutError:
+            pass
@@ -0,0 +1,140 @@
+import logging
+from asyncio import create_task, gather, get_running_loop
+
+from lib_cloud_sched import CallPriority
+
+RRSET_KEYS = ('name', 'type', 'ttl', 'rrdatas')
+
+
+class _Batch:
+    def __init__(self):
+        self.additions = []
+        self.deletions = []
+        self.names = set()
+        self.priority = CallPriority.BACKGROUND
+        self.handle = None
+
+    def __len__(self):
+        return len(self.additions) + len(self.deletions)
+
+
+class DnsBatcher:
+    def __init__(self, session, window, max_changes):
+        self._session = session
+        self._dns = session.dns()
+        self._scheduler = session.scheduler
+        self._pending = {}
+        self.window = window
+        self.max_changes = max_changes
+        self.change_sets = 0
+        self.changes = 0
+        self.fallbacks = 0
+
+        self.log = logging.getLogger(__name__)
+
+    def _queue(self, zone_name, kind, rrset, priority):
+        loop = get_running_loop()
+        batch = self._pending.get(zone_name)
+        # Changes to one name are applied in the order they were made
+        if batch and rrset['name'] in batch.names:
+            self._flush(zone_name)
+            batch = None
+        if not batch:
+            batch = self._pending[zone_name] = _Batch()
+            batch.handle = loop.call_later(
+                self.window, self._flush, zone_name
+            )
+        fut = loop.create_future()
+        getattr(batch, kind).append((rrset, fut))
+        batch.names.add(rrset['name'])
+        batch.priority = min(batch.priority, priority)
+        if len(batch) >= self.max_changes:
+            self._flush(zone_name)
+        return fut
+
+    def add(self, zone_name, name, ttl, rrdatas, priority):
+        rrset = {
+            'name': name,
+            'type': 'A',
+            'ttl': int(ttl),
+            'rrdatas': rrdatas,
+        }
+        return self._queue(zone_name, 'additions', rrset, priority)
+
+    def delete(self, zone_name, record_data, priority):
+        rrset = {key: record_data[key] for key in RRSET_KEYS}
+        return self._queue(zone_name, 'deletions', rrset, priority)
+
+    def _flush(self, zone_name):
+        batch = self._pending.pop(zone_name)
+        batch.handle.cancel()
+        create_task(self._submit(zone_name, batch))
+
+    async def _apply(self, zone, priority, additions, deletions):
+        records = {}
+        if additions:
+            records['additions'] = [rrset for rrset, _ in additions]
+        if deletions:
+            records['deletions'] = [rrset for rrset, _ in deletions]
+        result = await self._scheduler.call(
+            'dns', priority, self._dns.ex_bulk_record_changes, zone, records
+        )
+        self.change_sets += 1
+        self.changes += len(additions) + len(deletions)
+        # Additions come back in the order they were sent
+        for (_, fut), record in zip(additions, result['additions']):
+            if not fut.done():
+                fut.set_result(record)
+        for _, fut in deletions:
+            if not fut.done():
+                fut.set_result(True)
+
+    async def _apply_one(self, zone, priority, kind, change):
+        try:
+            if kind == 'additions':
+                await self._apply(zone, priority, [change], [])
+            else:
+                await self._apply(zone, priority, [], [change])
+        except Exception as e:
+            if not change[1].done():
+                change[1].set_exception(e)
+
+    async def _submit(self, zone_name, batch):
+        try:
+            zone = await self._scheduler.call(
+                'dns', batch.priority, self._session.dns_zone, zone_name
+            )
+            if len(batch) > 1:
+                try:
+                    await self._apply(
+                        zone, batch.priority, batch.additions,
+                        batch.deletions
+                    )
+                    return
+                except Exception as e:
+                    # A single conflicting record fails the whole change
+                    # set, find out which one
+                    self.log.warning(
+                        'Change set of %d failed, applying one by one: %s',
+                        len(batch), e
+                    )
+                    self.fallbacks += 1
+            await gather(
+                *(
+                    self._apply_one(zone, batch.priority, kind, change)
+                    for kind in ['additions', 'deletions']
+                    for change in getattr(batch, kind)
+                )
+            )
+        except Exception as e:
+            for _, fut in batch.additions + batch.deletions:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    def stats(self):
+        return {
+            'pending': sum(len(b) for b in self._pending.values()),
+            'change_sets': self.change_sets,
+            'changes': self.changes,
+            'fallbacks': self.fallbacks,
+        }
@@ -0,0 +1,161 @@
+import logging
+import time
+from asyncio import create_task, gather, get_running_loop, sleep
+
+from libcloud.common.types import LibcloudError
+
+
+class _Submitted(Exception):
+    def __init__(self, operation):
+        super().__init__(operation['name'])
+        self.operation = operation
+
+
+def submit_operation(driver, method, *args, **kwargs):
+    # libcloud polls every operation to completion on the calling thread.
+    # Only the initial request is sent here, the driver method is cut
+    # short as soon as the operation handle comes back.
+    connection = driver.connection
+
+    def async_request(
+        action, params=None, data=None, headers=None, method='GET',
+        context=None
+    ):
+        request = getattr(connection, connection.request_method)
+        response = request(
+            **connection.get_request_kwargs(
+                action=action,
+                params=params,
+                data=data,
+                headers=headers,
+                method=method,
+                context=context,
+            )
+        )
+        raise _Submitted(response.object)
+
+    connection.async_request = async_request
+    try:
+        getattr(driver, method)(*args, **kwargs)
+    except _Submitted as e:
+        return e.operation
+    finally:
+        del connection.async_request
+    return None
+
+
+def list_running_operations(driver):
+    names = set()
+    params = {'filter': 'status != DONE', 'maxResults': 500}
+    while True:
+        response = driver.connection.request(
+            '/aggregated/operations', params=dict(params)
+        ).object
+        for scope in response.get('items', {}).values():
+            for operation in scope.get('operations', []):
+                names.add(operation['name'])
+        if 'nextPageToken' not in response:
+            return names
+        params['pageToken'] = response['nextPageToken']
+
+
+def is_operation_done(driver, link):
+    # Raises the error of a failed operation, like libcloud does
+    connection = driver.connection
+    return connection.has_completed(connection.request(link))
+
+
+class _Waiter:
+    def __init__(self, operation, priority, timeout):
+        self.link = operation['selfLink']
+        self.priority = priority
+        self.ts_deadline = time.time() + timeout
+        self.future = get_running_loop().create_future()
+
+
+class OperationTracker:
+    def __init__(self, session, poll_interval):
+        self._compute = session.compute(None, None)
+        self._scheduler = session.scheduler
+        self._waiters = {}
+        self._task = None
+        self.poll_interval = poll_interval
+        self.polls = 0
+        self.completed = 0
+        self.failed = 0
+
+        self.log = logging.getLogger(__name__)
+
+    def wait(self, operation, priority, timeout):
+        waiter = _Waiter(operation, priority, timeout)
+        self._waiters[operation['name']] = waiter
+        if not self._task or self._task.done():
+            self._task = create_task(self._run())
+        return waiter.future
+
+    def _resolve(self, name, error=None):
+        waiter = self._waiters.pop(name)
+        if waiter.future.done():
+            return
+        if error:
+            self.failed += 1
+            waiter.future.set_exception(error)
+        else:
+            self.completed += 1
+            waiter.future.set_result(None)
+
+    async def _finish(self, name, waiter):
+        try:
+            done = await self._scheduler.call(
+                'compute', waiter.priority, self._compute.apply,
+                is_operation_done, waiter.link
+            )
+        except Exception as e:
+            self._resolve(name, e)
+            return
+        if done:
+            self._resolve(name)
+
+    async def _poll(self):
+        now = time.time()
+        for name, waiter in list(self._waiters.items()):
+            if waiter.future.done():
+                del self._waiters[name]
+            elif now >= waiter.ts_deadline:
+                self._resolve(
+                    name,
+                    LibcloudError('Operation %s did not complete' % name),
+                )
+        if not self._waiters:
+            return
+        priority = min(w.priority for w in self._waiters.values())
+        running = await self._scheduler.call(
+            'compute', priority, self._compute.apply,
+            list_running_operations
+        )
+        self.polls += 1
+        # Operations submitted while listing are absent too, they just
+        # stay tracked when fetching them shows they are still running
+        await gather(
+            *(
+                self._finish(name, waiter)
+                for name, waiter in list(self._waiters.items())
+                if name not in running
+            )
+        )
+
+    async def _run(self):
+        while self._waiters:
+            await sleep(self.poll_interval)
+            try:
+                await self._poll()
+            except:
+                self.log.exception('Failed to poll operations')
+
+    def stats(self):
+        return {
+            'in_flight': len(self._waiters),
+            'polls': self.polls,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+KINDS = ('nodes', 'volumes', 'addresses', 'records')
+
+
+class InventoryMiss(Exception):
+    pass
+
+
+class Inventory:
+    def __init__(self, session):
+        self._session = session
+        self._lock = threading.Lock()
+        self._index = {kind: {} for kind in KINDS}
+        self._touched = {}
+        self._prefixes = frozenset()
+        self._dns_zones = frozenset()
+        self.ts_refresh = 0
+
+        self.log = logging.getLogger(__name__)
+
+    def _covers(self, kind, name):
+        if not self.ts_refresh:
+            return False
+        if kind == 'records':
+            return name[0] in self._dns_zones
+        return any(name.startswith(p) for p in self._prefixes)
+
+    def lookup(self, kind, name):
+        with self._lock:
+            if not self._covers(kind, name):
+                raise InventoryMiss(kind, name)
+            return self._index[kind].get(name)
+
+    def put(self, kind, name, obj):
+        with self._lock:
+            self._index[kind][name] = obj
+            self._touched[kind, name] = time.time()
+
+    def discard(self, kind, name):
+        self.put(kind, name, None)
+
+    def _list(self, prefixes, dns_zones):
+        compute = self._session.compute(None, None)
+        dns = self._session.dns()
+
+        def select(objs):
+            return {
+                o.name: o
+                for o in objs if any(o.name.startswith(p) for p in prefixes)
+            }
+
+        index = {
+            'nodes': select(compute.list_nodes(ex_zone='all')),
+            'volumes': select(compute.list_volumes(ex_zone='all')),
+            'addresses': select(compute.ex_list_addresses(region='all')),
+            'records': {},
+        }
+        for zone_name in dns_zones:
+            zone = self._session.dns_zone(zone_name)
+            for record in dns.list_records(zone):
+                if record.type == 'A':
+                    index['records'][zone_name, record.name] = record
+        return index
+
+    def refresh(self, prefixes, dns_zones):
+        ts_list = time.time()
+        index = self._list(prefixes, dns_zones)
+        counts = {kind: len(index[kind]) for kind in KINDS}
+
+        with self._lock:
+            # Keep what our own mutations recorded while we were listing,
+            # the listing may predate them.
+            for (kind, name), ts in self._touched.items():
+                if ts >= ts_list:
+                    obj = self._index[kind].get(name)
+                    if obj is None:
+                        index[kind].pop(name, None)
+                    else:
+                        index[kind][name] = obj
+            self._touched = {
+                key: ts
+                for key, ts in self._touched.items() if ts >= ts_list
+            }
+            self._index = index
+            self._prefixes = frozenset(prefixes)
+            self._dns_zones = frozenset(dns_zones)
+            self.ts_refresh = ts_list
+
+        self.log.info(
+            'Refreshed in %.3fs: %s',
+            time.time() - ts_list,
+            ' '.join('%s=%d' % (kind, counts[kind]) for kind in KINDS),
+        )
@@ -0,0 +1,188 @@
+import copy
+import logging
+import threading
+from contextlib import contextmanager
+
+from libcloud.compute.drivers.gce import GCENodeDriver
+from libcloud.dns.drivers.google import GoogleDNSDriver
+
+from lib_cloud_sched import CloudScheduler
+from lib_dns_batch import DnsBatcher
+from lib_gce_ops import OperationTracker
+from lib_gcp_inventory import Inventory
+from lib_util import read_json
+
+
+class DriverPool:
+    def __init__(self, factory, max_size, on_open=None):
+        self._factory = factory
+        self._proto = None
+        self._proto_lock = threading.Lock()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._on_open = on_open
+        self.max_size = max_size
+        self.live = 0
+
+        self.log = logging.getLogger(__name__)
+
+    def _open(self):
+        # The first driver pays for authentication and zone/region lookups;
+        # further ones are cheap clones with their own HTTP connection.
+        with self._proto_lock:
+            if self._proto is None:
+                self._proto = self._factory()
+                driver = self._proto
+            else:
+                driver = copy.copy(self._proto)
+                driver.connection = copy.copy(self._proto.connection)
+                driver.connection.connection = None
+                driver.connection.driver = driver
+        if self._on_open:
+            self._on_open(driver)
+        return driver
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.live += 1
+        try:
+            driver = self._open()
+        except:
+            with self._lock:
+                self.live -= 1
+            raise
+        self.log.debug('Opened connection (%d live)', self.live)
+        return driver
+
+    @contextmanager
+    def borrow(self):
+        with self._slots:
+            driver = self._acquire()
+            try:
+                yield driver
+            finally:
+                with self._lock:
+                    self._idle.append(driver)
+
+
+class PooledDriver:
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            with self._pool.borrow() as driver:
+                return getattr(driver, name)(*args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    def apply(self, func, *args, **kwargs):
+        with self._pool.borrow() as driver:
+            return func(driver, *args, **kwargs)
+
+
+class GCPSession:
+    def __init__(self, app_config):
+        credentials_file = app_config.gcp_credentials_file
+        creds = read_json(credentials_file)
+        self.credentials_file = credentials_file
+        self.client_email = creds['client_email']
+        self.project = creds['project_id']
+        self.pool_size = app_config.gcp_connection_pool_size
+
+        self._lock = threading.Lock()
+        self._credential = None
+        self._pools = {}
+        self._dns_zones = {}
+        self.inventory = Inventory(self)
+        self.scheduler = CloudScheduler(
+            self.pool_size,
+            {
+                'compute': app_config.gcp_compute_rate,
+                'dns': app_config.gcp_dns_rate,
+            },
+            max_retries=app_config.gcp_max_retries,
+        )
+        self.dns_batcher = DnsBatcher(
+            self, app_config.dns_batch_window, app_config.dns_batch_max
+        )
+        self.operations = OperationTracker(
+            self, app_config.gcp_operation_poll_interval
+        )
+
+        self.log = logging.getLogger(__name__)
+
+    @property
+    def live_connections(self):
+        return sum(pool.live for pool in self._pools.values())
+
+    def _share_credential(self, driver):
+        with self._lock:
+            if self._credential is None:
+                self._credential = driver.connection.oauth2_credential
+            else:
+                driver.connection.oauth2_credential = self._credential
+
+    def _get_pool(self, key, factory):
+        with self._lock:
+            try:
+                return self._pools[key]
+            except KeyError:
+                pool = DriverPool(
+                    factory, self.pool_size, on_open=self._share_credential
+                )
+                self._pools[key] = pool
+                return pool
+
+    def compute(self, zone, timeout):
+        return PooledDriver(
+            self._get_pool(
+                ('compute', zone, timeout),
+                lambda: GCENodeDriver(
+                    self.client_email,
+                    self.credentials_file,
+                    project=self.project,
+                    datacenter=zone,
+                    timeout=timeout
+                ),
+            )
+        )
+
+    def dns(self):
+        return PooledDriver(
+            self._get_pool(
+                ('dns', ),
+                lambda: GoogleDNSDriver(
+                    self.client_email,
+                    self.credentials_file,
+                    project=self.project
+                ),
+            )
+        )
+
+    def dns_zone(self, name):
+        try:
+            return self._dns_zones[name]
+        except KeyError:
+            pass
+        zone = self.dns().get_zone(name)
+        with self._lock:
+            return self._dns_zones.setdefault(name, zone)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(app_config):
+    with _sessions_lock:
+        try:
+            return _sessions[app_config.gcp_credentials_file]
+        except KeyError:
+            session = GCPSession(app_config)
+            _sessions[app_config.gcp_credentials_file] = session
+            return session
@@ -0,0 +1,31 @@
+from collections import defaultdict
+
+
+class GenesisIndex:
+    def __init__(self, on_change=None):
+        self.groups = defaultdict(set)
+        self.on_change = on_change
+
+    def move(self, node, old, new):
+        if old:
+            group = self.groups[old]
+            group.discard(node)
+            if not group:
+                del self.groups[old]
+        if new:
+            self.groups[new].add(node)
+        if self.on_change:
+            self.on_change(node)
+
+    def major_groups(self):
+        if not self.groups:
+            return []
+        size = max(len(g) for g in self.groups.values())
+        return [g for g in self.groups.values() if len(g) == size]
+
+    def sizes(self):
+        return sorted(
+            ((genesis, len(g)) for genesis, g in self.groups.items()),
+            key=lambda i: i[1],
+            reverse=True,
+        )
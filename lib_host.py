@@ -1,3 +1,49 @@
+import abc
 import enum
 
+from lib_cloud_sched import CallPriority
+
 HostClean = enum.IntEnum('HostClean', 'STOP HOST DATA ALL')
+
+
+class Host(abc.ABC):
+    @abc.abstractmethod
+    async def start(self, priority=CallPriority.NORMAL):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def stop(
+        self, clean=HostClean.STOP, priority=CallPriority.NORMAL
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def is_down(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def adopt(
+        self, host_name, data_disk_name, priority=CallPriority.RECOVERY
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def provision_standby(
+        self, warmup, priority=CallPriority.BACKGROUND
+    ):
+        raise NotImplementedError
+
+
+def create_host(app_config, config, applied_file):
+    # Backends are imported lazily so that the fake one works without
+    # cloud credentials
+    if app_config.host_backend == 'fake':
+        from lib_host_fake import HostFake
+        return HostFake(
+            config,
+            app_config.fake_host_latency,
+            app_config.fake_host_failure_rate,
+        )
+    from lib_gcp_session import get_session
+    from lib_host_gcp import HostGCP
+    return HostGCP(config, get_session(app_config), applied_file)
@@ -0,0 +1,54 @@
+import logging
+import random
+from asyncio import sleep
+from collections import Counter
+
+from lib_cloud_sched import CallPriority
+from lib_host import Host, HostClean
+
+
+class HostFakeError(Exception):
+    pass
+
+
+class HostFake(Host):
+    def __init__(self, config, latency=0, failure_rate=0):
+        self.config = config
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.running = False
+        self.calls = Counter()
+        self.log = logging.getLogger(
+            __name__ + '.' + self.config['resources_name']
+        )
+
+    async def _operation(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.failure_rate:
+            raise HostFakeError(name + ' failed')
+
+    def is_down(self):
+        return not self.running
+
+    async def start(self, priority=CallPriority.NORMAL):
+        await self._operation('start')
+        self.running = True
+
+    async def stop(
+        self, clean=HostClean.STOP, priority=CallPriority.NORMAL
+    ):
+        await self._operation('stop')
+        self.running = False
+
+    async def adopt(
+        self, host_name, data_disk_name, priority=CallPriority.RECOVERY
+    ):
+        await self._operation('adopt')
+        self.running = True
+
+    async def provision_standby(
+        self, warmup, priority=CallPriority.BACKGROUND
+    ):
+        await self._operation('provision_standby')
@@ -1,47 +1,181 @@
+import copy
+import hashlib
 import json
 import logging
 import os
-from asyncio import get_running_loop
+from asyncio import Lock, create_task, get_running_loop, sleep
 from functools import partial
 from pathlib import Path
 
 from libcloud.common.google import (
-    ResourceNotFoundError, ResourceExistsError, ResourceInUseError,
-    InvalidRequestError
+    GoogleBaseError, ResourceNotFoundError, ResourceExistsError,
+    ResourceInUseError, InvalidRequestError
 )
-from libcloud.compute.drivers.gce import GCENodeDriver
-from libcloud.dns.drivers.google import GoogleDNSDriver
+from libcloud.compute.types import NodeState
 from libcloud.dns.types import RecordDoesNotExistError
 from schema import Schema, SchemaError, Use, And, Or, Optional as Opt
 
-from lib_host import HostClean
-from lib_util import run_async, read_json
+from lib_dag import Step, run_dag
+from lib_gce_ops import submit_operation
+from lib_gcp_inventory import InventoryMiss
+from lib_host import Host, HostClean
+from lib_cloud_sched import CallPriority
+from lib_config_store import get_config_store
+from lib_util import run_async, try_read_json
 
 
-class HostGCP():
-    def __init__(self, config, gcp_credentials_file):
+def _family(kind):
+    return 'dns' if kind == 'records' else 'compute'
+
+
+def fingerprint(value):
+    data = json.dumps(value, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class HostGCP(Host):
+    def __init__(self, config, session, applied_file):
         self.config = config
-        creds = read_json(gcp_credentials_file)
-        self._compute = GCENodeDriver(
-            creds['client_email'],
-            gcp_credentials_file,
-            project=creds['project_id'],
-            datacenter=self.config['gcp_compute_zone'],
-            timeout=self.config['compute_timeout']
-        )
-        self._dns = GoogleDNSDriver(
-            creds['client_email'],
-            gcp_credentials_file,
-            project=creds['project_id']
-        )
-        self._dns_zone = self._dns.get_zone(config['gcp_dns_zone'])
+        self._session = session
+        self._applied_file = applied_file
+        self._applied = try_read_json(applied_file, {})
+        self._applied_lock = Lock()
+        self._compute = session.compute(
+            self.config['gcp_compute_zone'], self.config['compute_timeout']
+        )
+        self._dns = session.dns()
+        self._dns_batcher = session.dns_batcher
+        self._operations = session.operations
+        self._inventory = session.inventory
+        self._scheduler = session.scheduler
+        self._priority = CallPriority.NORMAL
+        self.step_timings = {}
         self.log = logging.getLogger(__name__ + '.' + self._name)
 
     @property
     def _name(self):
         return self.config['resources_name']
 
-    async def start(self):
+    @property
+    def _data_disk_spec(self):
+        return {
+            'size': self.config['data_disk_size'],
+            'ssd': self.config['data_disk_ssd'],
+        }
+
+    async def _set_applied(self, key, value):
+        if value is None:
+            self._applied.pop(key, None)
+        else:
+            self._applied[key] = fingerprint(value)
+        await self._save_applied()
+
+    async def _save_applied(self):
+        # The only record of which host and disk this node owns, a torn
+        # write would orphan them
+        async with self._applied_lock:
+            await run_async(
+                get_config_store().write_json, self._applied_file,
+                copy.deepcopy(self._applied)
+            )
+
+    def _is_applied(self, key, value):
+        return self._applied.get(key) == fingerprint(value)
+
+    async def _set_binding(self, host_name, data_disk_name):
+        for key, value in [
+            ('host_name', host_name),
+            ('data_disk_name', data_disk_name),
+        ]:
+            if value is None:
+                self._applied.pop(key, None)
+            else:
+                self._applied[key] = value
+        await self._save_applied()
+
+    @property
+    def _host_name(self):
+        return self._applied.get('host_name', self._name)
+
+    @property
+    def _data_disk_name(self):
+        return self._applied.get('data_disk_name', self._name + '-data')
+
+    @property
+    def _record_key(self):
+        return self.config['gcp_dns_zone'], self.config['hostname']
+
+    def _call(self, family, func, *args, **kwargs):
+        return self._scheduler.call(
+            family, self._priority, func, *args, **kwargs
+        )
+
+    def _compute_call(self, func, *args, **kwargs):
+        return self._call('compute', func, *args, **kwargs)
+
+    def _dns_call(self, func, *args, **kwargs):
+        return self._call('dns', func, *args, **kwargs)
+
+    async def _compute_op(self, method, *args, priority=None, **kwargs):
+        # Holds a scheduler thread only to submit the operation, waiting
+        # for it is left to the shared tracker
+        priority = priority or self._priority
+        operation = await self._scheduler.call(
+            'compute', priority, self._compute.apply, submit_operation,
+            method, *args, **kwargs
+        )
+        if operation and operation.get('status') != 'DONE':
+            await self._operations.wait(
+                operation, priority, self.config['compute_timeout']
+            )
+
+    async def _lookup(self, kind, key, get):
+        try:
+            return self._inventory.lookup(kind, key)
+        except InventoryMiss:
+            pass
+        try:
+            obj = await self._call(_family(kind), get)
+        except (ResourceNotFoundError, RecordDoesNotExistError):
+            obj = None
+        self._inventory.put(kind, key, obj)
+        return obj
+
+    async def _ensure(self, kind, key, get, create):
+        obj = await self._lookup(kind, key, get)
+        if obj:
+            self.log.info('Exists')
+            return obj
+        try:
+            obj = await create()
+            self.log.info('Created')
+        except ResourceExistsError:
+            obj = await self._call(_family(kind), get)
+            self.log.info('Exists')
+        self._inventory.put(kind, key, obj)
+        return obj
+
+    async def _refresh_host(self):
+        try:
+            host = await self._compute_call(
+                self._compute.ex_get_node, self._host_name
+            )
+        except ResourceNotFoundError:
+            host = None
+        self._inventory.put('nodes', self._host_name, host)
+        return host
+
+    def is_down(self):
+        try:
+            host = self._inventory.lookup('nodes', self._host_name)
+        except InventoryMiss:
+            return False
+        return not host or host.state in [
+            NodeState.STOPPED, NodeState.TERMINATED
+        ]
+
+    async def start(self, priority=CallPriority.NORMAL):
+        self._priority = priority
         self.log.info('start() begins')
         try:
             await self._start()
@@ -51,74 +185,176 @@ class HostGCP():
         self.log.info('start() finished')
 
     async def _start(self):
-        try:
-            self.log.info('Creating external static IP address')
-            addr = await run_async(self._compute.ex_get_address, self._name)
-            self.log.info('Exists')
-        except ResourceNotFoundError:
-            addr = await run_async(self._compute.ex_create_address, self._name)
-            self.log.info('Created')
+        self.step_timings = await run_dag(
+            [
+                Step('address', [], self._start_address),
+                Step('dns_record', ['address'], self._start_dns_record),
+                Step('data_disk', [], self._start_data_disk),
+                Step('host', ['address'], self._start_host),
+                Step('attach', ['host', 'data_disk'], self._start_attach),
+                Step('tags', ['host'], self._start_tags),
+                Step('metadata', ['host'], self._start_metadata),
+                Step('machine_type', ['host'], self._start_machine_type),
+                Step(
+                    'start',
+                    ['host', 'attach', 'tags', 'metadata', 'machine_type'],
+                    self._start_power_on
+                ),
+            ],
+            self.log,
+        )
 
+    async def _start_address(self):
+        self.log.info('Creating external static IP address')
+        addr = await self._ensure(
+            'addresses', self._name,
+            partial(self._compute.ex_get_address, self._name),
+            self._create_address,
+        )
         self.log.info('External static IP address: %s', addr.address)
+        return addr
 
-        try:
-            self.log.info('Creating DNS record: %s', self.config['hostname'])
-            await run_async(
-                self._dns.create_record, self.config['hostname'],
-                self._dns_zone, 'A', {
-                    'ttl': self.config['hostname_ttl'],
-                    'rrdatas': [addr.address]
-                }
-            )
-            self.log.info('Created')
-        except ResourceExistsError:
-            self.log.info('Exists')
+    async def _create_address(self):
+        await self._compute_op('ex_create_address', self._name)
+        return await self._compute_call(
+            self._compute.ex_get_address, self._name
+        )
 
-        try:
-            self.log.info('Creating data disk')
-            data_disk_name = self._name + '-data'
-            data_disk = await run_async(
-                self._compute.ex_get_volume, data_disk_name
+    def _get_record(self):
+        # Runs on a scheduler thread, like the other lookups
+        dns_zone = self._session.dns_zone(self.config['gcp_dns_zone'])
+        return self._dns.get_record(
+            dns_zone.id, 'A:' + self.config['hostname']
+        )
+
+    async def _create_record(self, addr):
+        record = await self._dns_batcher.add(
+            self.config['gcp_dns_zone'],
+            self.config['hostname'],
+            self.config['hostname_ttl'],
+            [addr.address],
+            self._priority,
+        )
+        # Deleting needs the exact record set, keeping it saves a lookup
+        self._applied['dns_record'] = record.data
+        await self._save_applied()
+        return record
+
+    def _delete_record(self, record_data):
+        return self._dns_batcher.delete(
+            self.config['gcp_dns_zone'], record_data, self._priority
+        )
+
+    async def _start_dns_record(self, addr):
+        self.log.info('Creating DNS record: %s', self.config['hostname'])
+        await self._ensure(
+            'records', self._record_key, self._get_record,
+            partial(self._create_record, addr)
+        )
+
+    async def _create_data_disk(self):
+        await self._compute_op(
+            'create_volume',
+            self.config['data_disk_size'],
+            self._data_disk_name,
+            ex_disk_type=(
+                'pd-ssd' if self.config['data_disk_ssd'] else 'pd-standard'
             )
-            self.log.info('Exists')
-        except ResourceNotFoundError:
-            data_disk = await run_async(
-                self._compute.create_volume,
-                self.config['data_disk_size'],
-                data_disk_name,
-                ex_disk_type=(
-                    'pd-ssd' if self.config['data_disk_ssd'] else 'pd-standard'
+        )
+        data_disk = await self._compute_call(
+            self._compute.ex_get_volume, self._data_disk_name
+        )
+        await self._set_applied('data_disk', self._data_disk_spec)
+        return data_disk
+
+    async def _start_data_disk(self):
+        self.log.info('Creating data disk')
+        data_disk = await self._ensure(
+            'volumes', self._data_disk_name,
+            partial(self._compute.ex_get_volume, self._data_disk_name),
+            self._create_data_disk,
+        )
+
+        spec = self._data_disk_spec
+        if not self._is_applied('data_disk', spec):
+            if int(data_disk.size) < spec['size']:
+                self.log.info('Resizing data disk to %sGB', spec['size'])
+                await self._compute_op(
+                    'ex_resize_volume', data_disk, spec['size']
                 )
-            )
-            self.log.info('Created')
+                data_disk = await self._compute_call(
+                    self._compute.ex_get_volume, self._data_disk_name
+                )
+                self._inventory.put('volumes', self._data_disk_name, data_disk)
+            if data_disk.extra['type'].endswith('pd-ssd') != spec['ssd']:
+                self.log.warning(
+                    'Data disk type differs from config, '
+                    'it can only be changed by recreating the disk'
+                )
+            await self._set_applied('data_disk', spec)
 
         self.log.info(
             'Data disk: %sGB %s', data_disk.size, data_disk.extra['type']
         )
+        return data_disk
 
-        try:
-            self.log.info('Creating host')
-            host = await run_async(self._compute.ex_get_node, self._name)
-            self.log.info('Exists')
-        except ResourceNotFoundError:
-            host = await run_async(
-                self._compute.create_node,
-                self._name,
-                location=self.config['gcp_compute_zone'],
-                size=self.config['machine_type'],
-                image=self.config['boot_image'],
-                external_ip=addr,
-                ex_network=self.config['gcp_compute_net'],
-                ex_subnetwork=self.config['gcp_compute_subnet'],
-            )
-            self.log.info('Created')
+    async def _create_host(self, addr):
+        await self._compute_op(
+            'create_node',
+            self._host_name,
+            location=self.config['gcp_compute_zone'],
+            size=self.config['machine_type'],
+            image=self.config['boot_image'],
+            external_ip=addr,
+            ex_network=self.config['gcp_compute_net'],
+            ex_subnetwork=self.config['gcp_compute_subnet'],
+        )
+        host = await self._compute_call(
+            self._compute.ex_get_node, self._host_name
+        )
+        await self._set_applied('tags', None)
+        await self._set_applied('metadata', None)
+        await self._set_applied('machine_type', self.config['machine_type'])
+        return host
 
+    async def _start_host(self, addr):
+        self.log.info('Creating host')
+        host = await self._ensure(
+            'nodes', self._host_name,
+            partial(self._compute.ex_get_node, self._host_name),
+            partial(self._create_host, addr),
+        )
         self.log.info('Host: %s %s', host.extra['image'], host.size)
+        return host
+
+    async def _start_machine_type(self, host):
+        machine_type = self.config['machine_type']
+        if self._is_applied('machine_type', machine_type):
+            return
+        if host.size == machine_type:
+            await self._set_applied('machine_type', machine_type)
+            return
+        if host.state not in [NodeState.STOPPED, NodeState.TERMINATED]:
+            self.log.warning(
+                'Host is running, machine type %s will be applied after '
+                'the next stop', machine_type
+            )
+            return
+        self.log.info('Setting machine type: %s', machine_type)
+        await self._compute_op('ex_set_machine_type', host, machine_type)
+        await self._set_applied('machine_type', machine_type)
 
+    async def _start_attach(self, host, data_disk):
+        self.log.info('Attaching data disk')
+        if any(
+            d.get('source', '').endswith('/disks/' + data_disk.name)
+            for d in host.extra.get('disks', [])
+        ):
+            self.log.info('Already attached')
+            return
         try:
-            self.log.info('Attaching data disk')
-            await run_async(
-                self._compute.attach_volume,
+            await self._compute_op(
+                'attach_volume',
                 host,
                 data_disk,
                 ex_auto_delete=False
@@ -127,23 +363,175 @@ class HostGCP():
         except ResourceInUseError:
             self.log.info('Already attached')
 
+    async def _start_tags(self, host):
         self.log.info('Setting host tags')
-        await run_async(
-            self._compute.ex_set_node_tags, host,
-            self.config['gcp_compute_tags']
-        )
+        tags = self.config['gcp_compute_tags']
+        if self._is_applied('tags', tags):
+            self.log.info('Unchanged')
+            return
+        host = await self._refresh_host() or host
+        await self._compute_op('ex_set_node_tags', host, tags)
+        await self._set_applied('tags', tags)
 
+    async def _start_metadata(self, host):
         self.log.info('Setting host metadata')
-        await run_async(
-            self._compute.ex_set_node_metadata, host,
-            self.config['host_metadata']
-        )
+        metadata = self.config['host_metadata']
+        if self._is_applied('metadata', metadata):
+            self.log.info('Unchanged')
+            return
+        # Sent along with the metadata fingerprint of the instance, the
+        # inventory copy can be a main loop cycle old
+        host = await self._refresh_host() or host
+        await self._compute_op('ex_set_node_metadata', host, metadata)
+        await self._set_applied('metadata', metadata)
 
+    async def _start_power_on(self, host, *_):
         self.log.info('Starting host')
-        await run_async(self._compute.ex_start_node, host)
+        await self._compute_op('ex_start_node', host)
+        await self._refresh_host()
         self.log.info('Started')
 
-    async def stop(self, clean=HostClean.STOP) -> None:
+    async def provision_standby(
+        self, warmup, priority=CallPriority.BACKGROUND
+    ):
+        self._priority = priority
+        self.log.info('provision_standby() begins')
+        await run_dag(
+            [
+                Step('data_disk', [], self._start_data_disk),
+                Step('host', [], partial(self._start_host, 'ephemeral')),
+                Step('attach', ['host', 'data_disk'], self._start_attach),
+                Step('tags', ['host'], self._start_tags),
+                Step('metadata', ['host'], self._start_metadata),
+            ],
+            self.log,
+        )
+        # Let the first boot fetch and unpack the rnode package
+        await sleep(warmup)
+        self.log.info('Stopping host')
+        host = await self._refresh_host()
+        await self._compute_op('ex_stop_node', host)
+        await self._refresh_host()
+        self.log.info('provision_standby() finished')
+
+    async def _release_external_ip(self, host):
+        for nic in host.extra.get('networkInterfaces', []):
+            for access_config in nic.get('accessConfigs', []):
+                self.log.info(
+                    'Removing access config %s from %s', access_config['name'],
+                    host.name
+                )
+                await self._compute_op(
+                    'ex_delete_access_config', host, access_config['name'],
+                    nic['name']
+                )
+
+    async def _destroy_host(self, host, priority=None):
+        # destroy_boot_disk would be a second operation within the same
+        # driver call, submit_operation only sees the first one
+        await self._compute_op('destroy_node', host, priority=priority)
+        boot_disk = host.extra.get('boot_disk')
+        if not boot_disk or any(
+            d.get('boot') and d.get('autoDelete')
+            for d in host.extra.get('disks', [])
+        ):
+            return
+        try:
+            await self._compute_op(
+                'destroy_volume', boot_disk, priority=priority
+            )
+        except ResourceNotFoundError:
+            pass
+
+    async def _destroy_replaced(self, host, data_disk_name):
+        priority = CallPriority.BACKGROUND
+        try:
+            self.log.info('Removing replaced host %s', host.name)
+            await self._destroy_host(host, priority)
+            self._inventory.discard('nodes', host.name)
+            data_disk = await self._scheduler.call(
+                'compute', priority, self._compute.ex_get_volume,
+                data_disk_name
+            )
+            await self._compute_op(
+                'destroy_volume', data_disk, priority=priority
+            )
+            self._inventory.discard('volumes', data_disk_name)
+            self.log.info('Removed replaced host')
+        except ResourceNotFoundError:
+            self.log.info('Replaced host already removed')
+        except:
+            self.log.exception('Failed to remove replaced host')
+
+    async def adopt(
+        self, host_name, data_disk_name, priority=CallPriority.RECOVERY
+    ):
+        self._priority = priority
+        self.log.info('adopt(%s) begins', host_name)
+        old_host_name = self._host_name
+        old_data_disk_name = self._data_disk_name
+
+        addr = await self._start_address()
+        old_host = await self._lookup(
+            'nodes', old_host_name,
+            partial(self._compute.ex_get_node, old_host_name)
+        )
+        if old_host:
+            await self._release_external_ip(old_host)
+
+        await self._set_binding(host_name, data_disk_name)
+        for key in ['tags', 'metadata', 'machine_type']:
+            await self._set_applied(key, None)
+        # The standby disk came from the standby template, it is resized
+        # to this node's spec by the data disk step
+        await self._set_applied('data_disk', None)
+
+        host = await self._refresh_host()
+        await self._release_external_ip(host)
+        await self._compute_op(
+            'ex_add_access_config', host, 'External NAT', 'nic0',
+            nat_ip=addr.address
+        )
+        await self._refresh_host()
+        await self._start()
+        self.log.info('adopt() finished')
+
+        if old_host:
+            create_task(self._destroy_replaced(old_host, old_data_disk_name))
+
+    async def _stop_dns_record(self):
+        self.log.info('Removing DNS record')
+        try:
+            record = self._inventory.lookup('records', self._record_key)
+            record_data = record and record.data
+        except InventoryMiss:
+            record_data = self._applied.get('dns_record', False)
+        try:
+            if record_data is False:
+                record = await self._dns_call(self._get_record)
+                record_data = record.data
+            if record_data:
+                try:
+                    await self._delete_record(record_data)
+                except GoogleBaseError as e:
+                    if e.code != 'conditionNotMet':
+                        raise
+                    # Changed since we saw it, remove what is there now
+                    record = await self._dns_call(self._get_record)
+                    await self._delete_record(record.data)
+                self.log.info('Removed')
+            else:
+                self.log.info('Not present')
+        except (RecordDoesNotExistError, ResourceNotFoundError):
+            self.log.info('Not present')
+        self._applied.pop('dns_record', None)
+        await self._save_applied()
+        self._inventory.discard('records', self._record_key)
+
+    async def stop(
+        self, clean=HostClean.STOP, priority=CallPriority.NORMAL
+    ) -> None:
+        self._priority = priority
         self.log.info('stop(clean=%s) begins', clean.name)
         try:
             await self._stop(clean)
@@ -153,58 +541,71 @@ class HostGCP():
         self.log.info('stop() finished')
 
     async def _stop(self, clean) -> None:
-        try:
-            self.log.info('Stopping host')
-            host = await run_async(
-                self._compute.ex_get_node, self._name,
+        self.log.info('Stopping host')
+        host = await self._lookup(
+            'nodes', self._host_name,
+            partial(
+                self._compute.ex_get_node, self._host_name,
                 self.config['gcp_compute_zone']
             )
-            await run_async(self._compute.ex_stop_node, host)
-            self.log.info('Stopped')
+        )
+        try:
+            if host:
+                await self._compute_op('ex_stop_node', host)
+                await self._refresh_host()
+                self.log.info('Stopped')
+            else:
+                self.log.info('Not present')
 
             if clean <= HostClean.STOP:
                 return
 
-            self.log.info('Removing host')
-            await run_async(
-                self._compute.destroy_node, host, destroy_boot_disk=True
-            )
-            self.log.info('Removed')
+            if host:
+                self.log.info('Removing host')
+                await self._destroy_host(host)
+                for key in ['tags', 'metadata', 'machine_type']:
+                    await self._set_applied(key, None)
+                await self._set_binding(
+                    None, self._applied.get('data_disk_name')
+                )
+                self.log.info('Removed')
 
         except ResourceNotFoundError:
             self.log.info('Not present')
+            host = None
+
+        if not host or clean > HostClean.STOP:
+            self._inventory.discard('nodes', self._host_name)
 
         if clean <= HostClean.HOST:
             return
 
+        self.log.info('Removing data disk')
+        data_disk = await self._lookup(
+            'volumes', self._data_disk_name,
+            partial(self._compute.ex_get_volume, self._data_disk_name)
+        )
         try:
-            self.log.info('Removing data disk')
-            data_disk_name = self._name + '-data'
-            data_disk = await run_async(
-                self._compute.ex_get_volume, data_disk_name
-            )
-            await run_async(self._compute.destroy_volume, data_disk)
-            self.log.info('Removed')
+            if data_disk:
+                await self._compute_op('destroy_volume', data_disk)
+                await self._set_applied('data_disk', None)
+                await self._set_binding(self._applied.get('host_name'), None)
+                self.log.info('Removed')
+            else:
+                self.log.info('Not present')
         except ResourceNotFoundError:
             self.log.info('Not present')
+        self._inventory.discard('volumes', self._data_disk_name)
 
         if clean <= HostClean.DATA:
             return
 
-        try:
-            self.log.info('Removing DNS record')
-            record = await run_async(
-                self._dns.get_record, self._dns_zone.id,
-                'A:' + self.config['hostname']
-            )
-            await run_async(self._dns.delete_record, record)
-            self.log.info('Removed')
-        except RecordDoesNotExistError:
-            self.log.info('Not present')
+        await self._stop_dns_record()
 
         try:
             self.log.info('Removing external static IP address')
-            await run_async(self._compute.ex_destroy_address, self._name)
+            await self._compute_op('ex_destroy_address', self._name)
             self.log.info('Removed')
         except ResourceNotFoundError:
             self.log.info('Not present')
+        self._inventory.discard('addresses', self._name)
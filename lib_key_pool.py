@@ -0,0 +1,145 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from asyncio import Event, gather, get_running_loop
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nacl.secret
+import nacl.utils
+
+import lib_rchain_key
+import lib_rnode_tls
+from lib_config_store import get_config_store
+
+
+def generate_key_material():
+    return {
+        'validator_key': lib_rchain_key.generate_key_hex(),
+        'tls_key': lib_rnode_tls.generate_key_pem(),
+    }
+
+
+def _read_secret(path):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return Path(path).read_bytes()
+    secret = nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+class KeyPool:
+    def __init__(self, app_config):
+        self.app_config = app_config
+        self.size = app_config.key_pool_size
+        self.low_water = app_config.key_pool_low_water
+        self.generating = 0
+        self.taken = 0
+        self.misses = 0
+
+        self.log = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._ready = []
+        if self.size:
+            os.makedirs(self.data_dir, mode=0o700, exist_ok=True)
+            self._box = nacl.secret.SecretBox(
+                _read_secret(app_config.key_pool_secret_file)
+            )
+            self._ready = sorted(
+                p.name for p in self.data_dir.iterdir() if p.suffix == '.key'
+            )
+        self._loop = None
+        self._wakeup = None
+        self._executor = None
+
+    @property
+    def data_dir(self) -> Path:
+        return Path(self.app_config.data_dir).resolve() / 'key-pool'
+
+    def take(self):
+        with self._lock:
+            name = self._ready.pop() if self._ready else None
+            if name is None:
+                self.misses += 1
+            else:
+                self.taken += 1
+            low = len(self._ready) < self.low_water
+        # Called from the load executor threads
+        if low and self._loop:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        if name is None:
+            return None
+        path = self.data_dir / name
+        material = json.loads(self._box.decrypt(path.read_bytes()))
+        os.unlink(path)
+        return material
+
+    def _store(self, material):
+        data = self._box.encrypt(json.dumps(material).encode())
+        name = uuid.uuid4().hex + '.key'
+        get_config_store().write_bytes(self.data_dir / name, data)
+        with self._lock:
+            self._ready.append(name)
+
+    async def _generate(self):
+        loop = get_running_loop()
+        try:
+            material = await loop.run_in_executor(
+                self._executor, generate_key_material
+            )
+            await loop.run_in_executor(None, self._store, material)
+        except:
+            self.log.exception('Failed to generate key material')
+        finally:
+            self.generating -= 1
+
+    async def run(self):
+        if not self.size:
+            return
+        self._loop = get_running_loop()
+        self._wakeup = Event()
+        # Forking would copy the scheduler and loader threads' locks
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.app_config.key_pool_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        while True:
+            with self._lock:
+                missing = self.size - len(self._ready) - self.generating
+            if missing > 0:
+                self.log.info('Generating %d key pairs', missing)
+                self.generating += missing
+                await gather(*(self._generate() for _ in range(missing)))
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'ready': len(self._ready),
+                'generating': self.generating,
+                'taken': self.taken,
+                'misses': self.misses,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(app_config):
+    with _pools_lock:
+        try:
+            return _pools[app_config]
+        except KeyError:
+            pool = KeyPool(app_config)
+            _pools[app_config] = pool
+            return pool
@@ -3,15 +3,25 @@ import os
 import os.path
 import random
 import time
-from asyncio import Task, Lock, create_task, sleep
-from collections import defaultdict
+from asyncio import Task, Lock, create_task, gather, get_running_loop, sleep
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from itertools import groupby
 from types import SimpleNamespace
 
 import lib_app_config
 import lib_node_ctx
+from lib_cloud_sched import CallPriority
+from lib_config_store import get_config_store
+from lib_deadlines import DeadlineHeap
+from lib_gcp_session import get_session
+from lib_genesis_index import GenesisIndex
+from lib_key_pool import get_key_pool
+from lib_node_jobs import NodeJobs
+from lib_package_mirror import PackageMirror
+from lib_rolling_restart import RestartAction, RollingRestart
+from lib_standby import StandbyPool
+from lib_state_journal import StateJournal
+from lib_templates import get_template_cache
 from lib_util import *
 
 
@@ -21,97 +31,342 @@ class NetworkContext:
 
         self.nodes = {}
         self.leader = None
+        self.genesis_index = GenesisIndex(self._on_genesis_change)
+        self.deadlines = DeadlineHeap()
+        self.journal = StateJournal(self.config.data_dir)
+        self.decisions_enabled = False
+        self._dirty = set()
+        self._evaluate_handle = None
+        self.restarts = RollingRestart(
+            self, self.config.restart_max_unavailable
+        )
+        self.standbys = StandbyPool(self.config)
+        self.keys = get_key_pool(self.config)
+        self.jobs = NodeJobs(self)
+        self.packages = PackageMirror(self.config, self._on_package_ready)
 
         self.log = logging.getLogger(__name__)
+        self._load_executor = ThreadPoolExecutor(
+            max_workers=self.config.startup_workers,
+            thread_name_prefix='node-load',
+        )
 
-    def create_node(self, name, config_user=None):
+    @property
+    def gcp_session(self):
+        return get_session(self.config)
+
+    async def refresh_inventory(self):
+        if self.config.host_backend != 'gcp':
+            return
+        nodes = [node for node in self.nodes.values() if not node.loading]
+        if not nodes:
+            return
         try:
-            self.log.info('Creating node %s', name)
-            node = lib_node_ctx.NodeContext(
-                self.config,
-                os.path.join(self.config.nodes_data_dir, name),
-                name,
-                config_user,
+            await self.gcp_session.scheduler.call(
+                'compute',
+                CallPriority.BACKGROUND,
+                self.gcp_session.inventory.refresh,
+                {node.config['resources_name_prefix'] for node in nodes},
+                {node.config['gcp_dns_zone'] for node in nodes},
+            )
+        except:
+            self.log.exception('Failed to refresh inventory')
+
+    def stats(self):
+        stats = {
+            'restarts': self.restarts.stats(),
+            'standbys': self.standbys.stats(),
+            'config_store': get_config_store().stats(),
+            'key_pool': self.keys.stats(),
+            'jobs': self.jobs.stats(),
+            'packages': self.packages.stats(),
+        }
+        if self.config.host_backend == 'gcp':
+            stats['cloud_connections'] = self.gcp_session.live_connections
+            stats['cloud_scheduler'] = self.gcp_session.scheduler.stats()
+            stats['dns_batcher'] = self.gcp_session.dns_batcher.stats()
+            stats['gce_operations'] = self.gcp_session.operations.stats()
+        return stats
+
+    async def create_node(self, name, config_user=None, start=True):
+        self.log.info('Creating node %s', name)
+        node = lib_node_ctx.NodeContext(
+            self.config,
+            os.path.join(self.config.nodes_data_dir, name),
+            name,
+            self.genesis_index,
+            self.deadlines,
+            self.journal,
+            self.packages,
+        )
+        self.nodes[name] = node
+        try:
+            await get_running_loop().run_in_executor(
+                self._load_executor, node.load, config_user
             )
-            self.nodes[name] = node
-            node.try_start_async()
-            self.log.info('Created')
         except:
-            self.log.exception('Failed to create node')
+            del self.nodes[name]
+            self.log.exception('Failed to create node %s', name)
             raise
+        if start:
+            node.try_start_async()
+        self.log.info('Created node %s', name)
+        return node
 
-    async def run(self):
+    async def load_nodes(self):
+        ts_begin = time.time()
         for d in [
             self.config.nodes_data_dir,
             self.config.node_config_templates_dir,
         ]:
             os.makedirs(d, exist_ok=True)
-        for name in os.listdir(self.config.nodes_data_dir):
-            self.create_node(name)
+        names = await run_async(os.listdir, self.config.nodes_data_dir)
+        ts_scan = time.time()
+        self.log.info(
+            'Startup phase "scan" took %.3fs (%d nodes)', ts_scan - ts_begin,
+            len(names)
+        )
+
+        results = await gather(
+            *(self.create_node(name, start=False) for name in names),
+            return_exceptions=True,
+        )
+        ts_load = time.time()
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        self.log.info(
+            'Startup phase "load" took %.3fs (%d loaded, %d failed)',
+            ts_load - ts_scan,
+            len(results) - failed,
+            failed,
+        )
+
+        restored = self.restore_state()
+        ts_restore = time.time()
+        self.log.info(
+            'Startup phase "restore" took %.3fs (%d nodes)',
+            ts_restore - ts_load, restored
+        )
+
+        await self.refresh_inventory()
+        ts_inventory = time.time()
+        self.log.info(
+            'Startup phase "inventory" took %.3fs', ts_inventory - ts_restore
+        )
+
+        # Nodes created through the API meanwhile start once they load
+        for node in results:
+            if not isinstance(node, Exception) and not node.loading:
+                node.try_start_async()
+        self.log.info('Startup took %.3fs', ts_inventory - ts_begin)
+
+    async def update_node(self, node, config_user=None):
+        config = await get_running_loop().run_in_executor(
+            self._load_executor, node.render_config, config_user
+        )
+        if node.apply_config(config):
+            self.log.info('Config changed: %s', node)
+            node.gen_cookie_exec()
+
+    async def _rerender_node(self, node):
+        try:
+            await self.update_node(node)
+        except:
+            self.log.exception('Failed to re-render config of %s', node)
+
+    async def watch_templates(self):
+        templates = get_template_cache(self.config)
+        while True:
+            await sleep(self.config.template_poll_interval)
+            changed = await run_async(templates.changed)
+            if not changed:
+                continue
+            nodes = [
+                self.nodes[name]
+                for name in sorted(templates.dependents(changed))
+                if name in self.nodes and not self.nodes[name].loading
+            ]
+            self.log.info(
+                'Re-rendering %d nodes after template change', len(nodes)
+            )
+            await gather(*(self._rerender_node(node) for node in nodes))
+
+    def restore_state(self):
+        states, leader = self.journal.load()
+        restored = 0
+        for name, state in states.items():
+            node = self.nodes.get(name)
+            if node and not node.loading:
+                node.restore_state(state, self.nodes)
+                restored += 1
+        self.leader = self.nodes.get(leader)
+        if self.leader:
+            self.log.info('Restored leader: %s', self.leader)
+        self.save_state()
+        return restored
+
+    def save_state(self):
+        self.journal.snapshot(
+            {
+                name: node.state()
+                for name, node in self.nodes.items() if not node.loading
+            },
+            self.leader.name if self.leader else None,
+        )
+
+    async def run(self):
+        create_task(self.keys.run())
+        await self.load_nodes()
+        create_task(self.restarts.run())
+        create_task(self.watch_templates())
         try:
-            await sleep(self.config.initial_delay)
+            # With the leader known from the journal, hosts only need to
+            # confirm it, instead of all reporting in from scratch
+            await sleep(
+                self.config.warm_start_delay
+                if self.leader else self.config.initial_delay
+            )
+            self.decisions_enabled = True
             await self.main_loop()
         except:
             self.log.exception('Main loop failed')
             raise
 
     async def main_loop(self):
+        ts_tick = 0
         while True:
             #import asyncio
             #self.log.info('Running async tasks:')
             #for t in asyncio.all_tasks():
             #    self.log.info('  %s', t)
 
-            self.pick_majority()
-            await sleep(self.config.check_interval)
+            now = time.time()
+            if now >= ts_tick:
+                await self.refresh_inventory()
+                self.pick_majority()
+                self.save_state()
+                self.standbys.fill()
+                self.packages.retry_failed()
+                if self.config.host_backend == 'gcp':
+                    self.log.debug(
+                        'Live cloud connections: %d',
+                        self.gcp_session.live_connections,
+                    )
+                ts_tick = now + self.config.check_interval
+            else:
+                self.check_failures(self.deadlines.pop_due(now))
+            await self.deadlines.wait(ts_tick)
 
-    def pick_majority(self):
-        now = time.time()
-        groups_map = defaultdict(list)
+    def _on_package_ready(self, url):
+        nodes = [
+            node for node in self.nodes.values()
+            if not node.loading and node.config['rnode_package_url'] == url
+        ]
+        self.log.info('Package mirrored, updating %d nodes', len(nodes))
+        for node in nodes:
+            node.notify_reply()
+        self.packages.prune(
+            {
+                node.config['rnode_package_url']
+                for node in self.nodes.values() if not node.loading
+            }
+        )
+
+    def _on_genesis_change(self, node):
+        self._dirty.add(node)
+        if self.decisions_enabled and not self._evaluate_handle:
+            # Even without a debounce window, evaluation waits for the
+            # heartbeat that changed the index to finish
+            self._evaluate_handle = get_running_loop().call_later(
+                self.config.decision_debounce, self._evaluate
+            )
 
-        for node in self.nodes.values():
+    def _evaluate(self):
+        self._evaluate_handle = None
+        dirty, self._dirty = self._dirty, set()
+        if self.pick_leader():
+            self.correct_followers(self.nodes.values())
+        else:
+            self.correct_followers(
+                node for node in sorted(dirty, key=lambda n: n.name)
+                if node.name in self.nodes
+            )
+
+    def check_failures(self, nodes):
+        now = time.time()
+        for node in nodes:
             failure = node.check_failure(now)
-            if failure:
-                self.log.warn('Node has failure: %s', node)
-                node.try_restart_async()
+            node.rearm()
+            if not failure:
                 continue
-            if node.genesis:
-                groups_map[node.genesis].append(node)
-
-        if groups_map:
-            groups = sorted(groups_map.values(), key=len, reverse=True)
-            major_groups = list(next(groupby(groups, len))[1])
-
-            if self.log.isEnabledFor(logging.INFO):
-                self.log.info('Existing genesis blocks (hash / # nodes):')
-                for g in groups:
-                    self.log.info('  %s %d', g[0].genesis, len(g))
-
-            if self.leader:
-                for group in major_groups:
-                    if self.leader in group:
-                        break
-                else:
-                    self.leader = None
-
-            if not self.leader:
-                self.leader = random.choice(random.choice(major_groups))
-                self.leader.follows = None
-                self.log.info('Picked new leader: %s', self.leader)
+            self.log.warn('Node has failure: %s', node)
+            priority = CallPriority.RECOVERY
+            if node == self.leader:
+                priority = CallPriority.LEADER
+                # Not left to the debounced evaluation, by then the restart
+                # has cleared the failure and put the node back in its group
+                if self.pick_leader():
+                    self.correct_followers(self.nodes.values())
+            standby = (
+                failure in [
+                    lib_node_ctx.NodeFailure.TIMEOUT_START_HOST,
+                    lib_node_ctx.NodeFailure.TIMEOUT_HEARTBEAT,
+                ] and self.standbys.take(node)
+            )
+            if standby:
+                node.try_replace_async(
+                    standby, priority, self.standbys.release
+                )
             else:
-                self.log.info('Retained leader: %s', self.leader)
-
-            for node in self.nodes.values():
-                if node == self.leader:
-                    continue
-                if node.genesis not in [self.leader.genesis, None]:
-                    self.log.info('Node has invalid genesis: %s', node)
-                    node.genesis = None
-                    node.follows = self.leader
-                    node.try_restart_async(clean_data=True)
-                elif node.follows != self.leader:
-                    self.log.info('Node follows wrong leader: %s', node)
-                    node.follows = self.leader
-                    node.try_restart_async()
-        else:
+                node.try_restart_async(priority=priority)
+
+    def pick_leader(self):
+        if not self.genesis_index.groups:
             self.log.info('There are no genesis blocks')
+            return False
+
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info('Existing genesis blocks (hash / # nodes):')
+            for genesis, size in self.genesis_index.sizes():
+                self.log.info('  %s %d', genesis, size)
+
+        major_groups = self.genesis_index.major_groups()
+        if self.leader and any(self.leader in g for g in major_groups):
+            self.log.info('Retained leader: %s', self.leader)
+            return False
+
+        # Sorted so that a seeded random picks the same leader every time
+        self.leader = random.choice(
+            sorted(random.choice(major_groups), key=lambda n: n.name)
+        )
+        self.leader.set_follows(None)
+        self.journal.record_leader(self.leader.name)
+        self.log.info('Picked new leader: %s', self.leader)
+        return True
+
+    def correct_followers(self, nodes):
+        if not self.leader or not self.genesis_index.groups:
+            return
+        for node in nodes:
+            if node == self.leader or node.loading:
+                continue
+            if node.genesis not in [self.leader.genesis, None]:
+                action = RestartAction.CLEAN_DATA
+            elif node.follows != self.leader:
+                action = RestartAction.RECONFIGURE
+            else:
+                continue
+            # Until admitted the node keeps reporting its old genesis, the
+            # reset is left to the clean itself
+            if self.restarts.is_pending(node, action):
+                continue
+            if action == RestartAction.CLEAN_DATA:
+                self.log.info('Node has invalid genesis: %s', node)
+            else:
+                self.log.info('Node follows wrong leader: %s', node)
+            self.restarts.enqueue(node, action)
+
+    def pick_majority(self):
+        self.check_failures(list(self.nodes.values()))
+        self._dirty.clear()
+        self.pick_leader()
+        self.correct_followers(self.nodes.values())
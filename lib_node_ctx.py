@@ -1,5 +1,6 @@
 import enum
 import functools
+import itertools
 import logging
 import os
 import os.path
@@ -7,7 +8,8 @@ import pprint
 import time
 import uuid
 from asyncio import (
-    Task, Lock, CancelledError, create_task, create_subprocess_exec
+    Task, Event, Lock, CancelledError, TimeoutError, create_task,
+    create_subprocess_exec, wait_for
 )
 from pathlib import Path
 from subprocess import DEVNULL, CalledProcessError
@@ -16,11 +18,14 @@ from deepmerge import always_merger as merger
 
 import lib_rchain_key
 import lib_rnode_tls
+from lib_cloud_sched import CallPriority
 from lib_config import add_missing_value, add_missing_value_aux
-from lib_host import HostClean
-from lib_host_gcp import HostGCP
+from lib_config_store import get_config_store
+from lib_host import HostClean, create_host
+from lib_key_pool import get_key_pool
+from lib_templates import get_template_cache
 from lib_util import (
-    run_async, resolve_path, write_json, read_json, try_read_json
+    run_async, read_json, try_read_json
 )
 
 NodeFailure = enum.Enum(
@@ -28,41 +33,70 @@ NodeFailure = enum.Enum(
     TIMEOUT_HEARTBEAT
     TIMEOUT_START_RNODE
     TIMEOUT_START_HOST
+    HOST_DOWN
 '''
 )
 
 
+# Seeded from the clock so versions are not reused across restarts
+_reply_versions = itertools.count(int(time.time() * 1000))
+
+
 class NodeContextError(Exception):
     pass
 
 
 class NodeContext:
-    def __init__(self, app_config, data_dir, name, config_user=None):
+    def __init__(
+        self,
+        app_config,
+        data_dir,
+        name,
+        genesis_index=None,
+        deadlines=None,
+        journal=None,
+        packages=None,
+    ):
         self.app_config = app_config
         self.data_dir = Path(data_dir).resolve()
         self.name = name
+        self.genesis_index = genesis_index
+        self.deadlines = deadlines
+        self.journal = journal
+        self.packages = packages
+        self._index_key = None
+
+        self.loading = True
+        self.config = None
+        self.host = None
 
         self.host_up = False
-        self.genesis = None
+        self._genesis = None
         self.follows = None
         self.ts_start = 0
         self.ts_heartbeat = 0
-        self.failure = None
+        self.ts_rnode_report = 0
+        self._failure = None
 
         self.log = logging.getLogger(__name__ + '.' + name)
         self.maintenance_lock = Lock()
 
         self.cookie_exec = None
         self.cookie_data = None
-
-        self.load_config(config_user)
-        self.host = HostGCP(self.config, self.app_config.gcp_credentials_file)
+        self.cookie_data_pending = False
+        self.reply_sent = None
+        self._reply_changed = None
+        self._reply_cache = None
+        self._reply_inputs = None
+        self._reply_unchanged = None
 
     def __str__(self):
         return (
             'NodeContext(' + self.name + \
+            (' loading' if self.loading else '') + \
             (' up=' + ('1' if self.host_up else '0')) + \
             (' fail=' + self.failure.name if self.failure else '') + \
+            (' cleaning' if self.cookie_data_pending else '') + \
             (' ts_start=' + str(int(self.ts_start))) + \
             (' ts_heartbeat=' + str(int(self.ts_heartbeat))) + \
             (' follows=' + self.follows.name if self.follows else ' leader') + \
@@ -72,11 +106,111 @@ class NodeContext:
 
     __repr__ = __str__
 
+    def _update_index(self):
+        key = None if self._failure else self._genesis
+        if key != self._index_key:
+            old, self._index_key = self._index_key, key
+            if self.genesis_index:
+                self.genesis_index.move(self, old, key)
+
+    @property
+    def genesis(self):
+        return self._genesis
+
+    @genesis.setter
+    def genesis(self, value):
+        self._genesis = value
+        self._update_index()
+        self.rearm()
+        self.save_state()
+
+    @property
+    def failure(self):
+        return self._failure
+
+    @failure.setter
+    def failure(self, value):
+        self._failure = value
+        self._update_index()
+
     def gen_cookie_exec(self):
         self.cookie_exec = uuid.uuid4()
+        self.notify_reply()
+        self.save_state()
 
     def gen_cookie_data(self):
         self.cookie_data = uuid.uuid4()
+        self.notify_reply()
+        self.save_state()
+
+    def notify_reply(self):
+        # Drops the cached reply and wakes up hosts long-polling on
+        # /heartbeat
+        self._reply_cache = None
+        if self._reply_changed:
+            self._reply_changed.set()
+            self._reply_changed = None
+
+    def set_follows(self, leader):
+        if self.follows == leader:
+            return
+        self.log.info(
+            'Re-pointing to %s', leader.name if leader else 'self (leader)'
+        )
+        self.follows = leader
+        # A new cookie_exec makes the host restart rnode with the new
+        # leader on its next heartbeat, no host restart needed.
+        self.gen_cookie_exec()
+
+    def soft_clean_data(self):
+        # The host wipes its data disk in place (misc/data-disk-ctl clean)
+        # when it sees a new cookie_data; the disk itself is kept.
+        self.log.info('Scheduling data clean')
+        self.genesis = None
+        self.ts_start = time.time()
+        self.gen_cookie_data()
+        self.gen_cookie_exec()
+        self.cookie_data_pending = True
+        self.rearm()
+        self.save_state()
+
+    def state(self):
+        return {
+            'genesis': self.genesis,
+            'follows': self.follows.name if self.follows else None,
+            'host_up': self.host_up,
+            'cookie_exec': self.cookie_exec and str(self.cookie_exec),
+            'cookie_data': self.cookie_data and str(self.cookie_data),
+            'cookie_data_pending': self.cookie_data_pending,
+        }
+
+    def save_state(self):
+        # Config loading runs in a worker thread, the journal is written
+        # from the event loop only
+        if self.journal and not self.loading:
+            self.journal.record_node(self.name, self.state())
+
+    def restore_state(self, state, nodes):
+        self.host_up = state['host_up']
+        # Hosts get a full timeout to report back before they count as
+        # failed
+        self.ts_start = self.ts_heartbeat = time.time()
+        self.cookie_exec = state['cookie_exec']
+        self.cookie_data = state['cookie_data']
+        self.cookie_data_pending = state['cookie_data_pending']
+        self.follows = nodes.get(state['follows'])
+        self.notify_reply()
+        self.genesis = state['genesis']
+
+    def is_settled(self, ts):
+        if self.failure:
+            return True
+        return (
+            not self.loading and not self.maintenance_lock.locked() and
+            self.host_up and self.ts_heartbeat > ts and
+            self.ts_rnode_report > ts and not self.cookie_data_pending and
+            self.genesis is not None
+        )
 
     # properties {{{
 
@@ -120,6 +254,10 @@ class NodeContext:
     def config_file_full(self) -> Path:
         return self.data_dir / 'config.full.json'
 
+    @property
+    def config_file_applied(self) -> Path:
+        return self.data_dir / 'config.applied.json'
+
     @property
     def rnode_conf_file(self) -> Path:
         return self.files_dir / 'rnode.conf'
@@ -134,10 +272,7 @@ class NodeContext:
 
     def load_config_template(self, name):
         try:
-            path = resolve_path(
-                self.app_config.node_config_templates_dir, name + '.json'
-            )
-            return read_json(path)
+            return get_template_cache(self.app_config).get(name)
         except FileNotFoundError:
             raise NodeContextError(f'Template "{name}" does not exist')
 
@@ -168,19 +303,27 @@ class NodeContext:
     def load_config_full(self, config_user):
         config = self.load_config_merged(config_user)
         config_aux = try_read_json(self.config_file_auxiliary, {})
+        material = None
+
+        def key(name, generate):
+            # Only new nodes need keys, and they take them pre-generated
+            nonlocal material
+            if material is None:
+                material = get_key_pool(self.app_config).take() or {}
+            return material.get(name) or generate()
 
         config, config_aux = add_missing_value_aux(
             config,
             config_aux,
             '.rnode_conf.casper."validator-private-key"',
-            lambda: lib_rchain_key.generate_key_hex(),
+            lambda: key('validator_key', lib_rchain_key.generate_key_hex),
         )
 
         config, config_aux = add_missing_value_aux(
             config,
             config_aux,
             '.rnode_tls_key',
-            lambda: lib_rnode_tls.generate_key_pem(),
+            lambda: key('tls_key', lib_rnode_tls.generate_key_pem),
         )
 
         config = add_missing_value(
@@ -217,115 +360,234 @@ class NodeContext:
 
         return config, config_aux
 
-    def load_update_config(self, config_user=None):
+    def render_config(self, config_user=None):
+        # Blocking, runs in a worker thread (see NetworkContext)
         if config_user == None:
             config_user = try_read_json(self.config_file_user, {})
         config, config_aux = self.load_config_full(config_user)
 
+        store = get_config_store()
         os.makedirs(self.data_dir, exist_ok=True)
         if config_user:
-            write_json(self.config_file_user, config_user)
-        write_json(self.config_file_auxiliary, config_aux)
-        write_json(self.config_file_full, config)
+            store.write_json(self.config_file_user, config_user)
+        # Holds the generated keys, so it goes first
+        store.write_json(self.config_file_auxiliary, config_aux)
+        store.write_json(self.config_file_full, config)
 
         os.makedirs(self.files_dir, exist_ok=True)
-        write_json(self.rnode_conf_file, config['rnode_conf'])
-        self.rnode_tls_key_file.write_text(config['rnode_tls_key'])
+        store.write_json(self.rnode_conf_file, config['rnode_conf'])
+        store.write_text(self.rnode_tls_key_file, config['rnode_tls_key'])
+
+        return config
 
+    def apply_config(self, config):
+        changed = config != self.config
         self.config = config
-        self.gen_cookie_exec()
+        if self.host:
+            self.host.config = config
+        # The merged list also holds templates included by templates
+        get_template_cache(self.app_config).set_dependencies(
+            self.name, config.get('templates', [])
+        )
+        return changed
+
+    def load_update_config(self, config_user=None):
+        if self.apply_config(self.render_config(config_user)):
+            self.gen_cookie_exec()
 
     def load_config(self, config_user=None):
         if config_user == None and self.config_file_full.exists():
-            self.config = read_json(self.config_file_full)
+            self.apply_config(read_json(self.config_file_full))
         else:
             self.load_update_config(config_user)
 
+    def load(self, config_user=None):
+        self.load_config(config_user)
+        self.host = create_host(
+            self.app_config, self.config, self.config_file_applied
+        )
+        self.loading = False
+
     # }}}
 
     # lifecycle {{{
 
-    async def _stop(self, clean):
+    async def _stop(self, clean, priority=CallPriority.NORMAL):
         self.host_up = False
         self.failure = None
+        self.save_state()
         self.log.info('Stopping')
-        await self.host.stop(clean)
+        await self.host.stop(clean, priority)
         self.log.info('Stopped')
 
-    async def _start(self):
+    async def _start(self, priority=CallPriority.NORMAL):
         self.log.info('Starting')
-        await self.host.start()
+        await self.host.start(priority)
         if not self.host_up:
             self.ts_start = time.time()
         self.log.info('Started')
 
     async def _try_start(self):
         try:
-            if self.maintenance_lock.locked():
+            if self.host is None or self.maintenance_lock.locked():
                 return
             async with self.maintenance_lock:
                 await self._start()
         except:
             self.log.exception('Start failed')
             raise
+        finally:
+            self.rearm()
 
-    async def _try_restart(self, clean):
+    async def _try_restart(self, clean, priority):
         try:
             if self.maintenance_lock.locked():
                 return
             async with self.maintenance_lock:
                 skip_start = False
                 try:
-                    await self._stop(clean)
+                    await self._stop(clean, priority)
                 except CancelledError:
                     skip_start = True
                     raise
                 finally:
                     if not skip_start:
-                        await self._start()
+                        await self._start(priority)
         except:
             self.log.exception('Restart failed')
             raise
+        finally:
+            self.rearm()
+
+    async def _try_replace(self, standby, priority, on_skip):
+        try:
+            if self.maintenance_lock.locked():
+                on_skip(standby)
+                return
+            async with self.maintenance_lock:
+                self.host_up = False
+                self.failure = None
+                self.genesis = None
+                self.log.info('Replacing host with %s', standby['host_name'])
+                await self.host.adopt(
+                    standby['host_name'], standby['data_disk_name'], priority
+                )
+                self.ts_start = time.time()
+                self.log.info('Replaced')
+        except:
+            self.log.exception('Replace failed')
+            raise
+        finally:
+            self.rearm()
 
     def try_start_async(self):
         self.log.info('Scheduling start')
-        create_task(self._try_start())
+        return create_task(self._try_start())
 
-    def try_restart_async(self, clean_data=False):
+    def try_restart_async(
+        self, clean_data=False, priority=CallPriority.NORMAL
+    ):
         self.log.info('Scheduling restart')
         clean = HostClean.DATA if clean_data else HostClean.STOP
-        create_task(self._try_restart(clean))
+        create_task(self._try_restart(clean, priority))
+
+    def try_replace_async(self, standby, priority, on_skip):
+        self.log.info('Scheduling replace')
+        create_task(self._try_replace(standby, priority, on_skip))
 
     # }}}
 
-    def heartbeat(self, msg):
-        self.log.info('Received heartbeat message')
+    def _receive(self, msg):
+        self.log.debug('Received heartbeat message')
+
+        if self.loading:
+            self.log.info('Ignoring while loading')
+            return False
 
         if self.maintenance_lock.locked():
             self.log.info('Ignoring due to active maintenance')
-            return {}
+            return False
 
         now = time.time()
+        changed = False
         if not self.host_up:
             self.log.info('Host is up')
             self.host_up = True
             self.ts_start = now
+            changed = True
         self.ts_heartbeat = now
 
         if 'cookie_exec' in msg and not self.cookie_exec:
             self.cookie_exec = msg['cookie_exec']
+            self.notify_reply()
+            changed = True
 
         if 'cookie_data' in msg and not self.cookie_data:
             self.cookie_data = msg['cookie_data']
+            self.notify_reply()
+            changed = True
 
-        if 'genesis' in msg and self.genesis != msg['genesis']:
+        if (
+            self.cookie_data_pending and
+            msg.get('cookie_data') == str(self.cookie_data)
+        ):
+            self.log.info('Host applied new data cookie')
+            self.cookie_data_pending = False
+            changed = True
+
+        if changed:
+            self.save_state()
+
+        # Until the host has wiped its data, it still reports the old genesis
+        if (
+            not self.cookie_data_pending and 'genesis' in msg and
+            self.genesis != msg['genesis']
+        ):
             self.genesis = msg['genesis']
 
+        # rnode is up again after the last restart asked of it
+        if (
+            'genesis' in msg and
+            msg.get('cookie_exec') == str(self.cookie_exec)
+        ):
+            self.ts_rnode_report = now
+
+        self.rearm()
+        return True
+
+    def heartbeat(self, msg):
+        if not self._receive(msg):
+            return {}
+        return self._send_reply(msg)
+
+    def _reply(self):
+        # The leader's address comes from its config, which is replaced
+        # as a whole on reload, so identity is enough to spot a change
+        inputs = (self.config, self.follows and self.follows.config)
+        if (
+            self._reply_cache is None or
+            any(a is not b for a, b in zip(inputs, self._reply_inputs))
+        ):
+            self._reply_inputs = inputs
+            self._reply_cache = self._build_reply()
+            self._reply_unchanged = {
+                'version': self._reply_cache['version'],
+                'unchanged': True,
+            }
+        return self._reply_cache
+
+    def _build_reply(self):
         reply = {
+            'version': next(_reply_versions),
             'cookie_exec': self.cookie_exec,
             'cookie_data': self.cookie_data,
             'rnode_package_url': self.config['rnode_package_url']
         }
+        if self.packages:
+            url, sha256 = self.packages.resolve(reply['rnode_package_url'])
+            reply['rnode_package_url'] = url
+            if sha256:
+                reply['rnode_package_sha256'] = sha256
 
         if self.follows:
             reply['mode'] = 'follower'
@@ -333,36 +595,98 @@ class NodeContext:
         else:
             reply['mode'] = 'leader'
 
-        self.log.info('Sending reply')
+        self.log.info('New reply')
         if self.log.isEnabledFor(logging.INFO):
             for k in sorted(reply.keys()):
                 self.log.info('  reply[%s] = %s', k, reply[k])
 
         return reply
 
+    def _send_reply(self, msg):
+        reply = self._reply()
+        self.reply_sent = reply
+        if msg.get('version') == reply['version']:
+            self.log.debug('Sending unchanged reply')
+            return self._reply_unchanged
+        self.log.debug('Sending reply version %d', reply['version'])
+        return reply
+
+    def _host_outdated(self, msg):
+        reply = self._reply()
+        if 'version' in msg:
+            return msg['version'] != reply['version']
+        if reply is not self.reply_sent:
+            return True
+        # A rebooted host reports no or stale cookies
+        return any(
+            str(msg.get(k)) != str(reply[k])
+            for k in ('cookie_exec', 'cookie_data')
+        )
+
+    async def heartbeat_wait(self, msg, wait):
+        if self.loading or self._host_outdated(msg):
+            return self.heartbeat(msg)
+        if not self._receive(msg):
+            return {}
+
+        # Keep the hold below timeout_heartbeat so that an open request
+        # keeps counting as a live host
+        wait = min(wait, self.config['timeout_heartbeat'] / 2)
+        if not self._reply_changed:
+            self._reply_changed = Event()
+        try:
+            await wait_for(self._reply_changed.wait(), wait)
+        except TimeoutError:
+            pass
+
+        if self.loading or self.maintenance_lock.locked():
+            return {}
+        self.ts_heartbeat = time.time()
+        self.rearm()
+        return self._send_reply(msg)
+
+    def next_deadline(self):
+        if self.loading or self.failure or self.maintenance_lock.locked():
+            return None
+        if not self.host_up:
+            return self.ts_start + self.config['timeout_start_host']
+        ts = self.ts_heartbeat + self.config['timeout_heartbeat']
+        if not self.genesis:
+            ts = min(ts, self.ts_start + self.config['timeout_start_rnode'])
+        return ts
+
+    def rearm(self):
+        if self.deadlines is not None:
+            self.deadlines.arm(self, self.next_deadline())
+
     def _check_timeouts(self, ts):
         if (
             self.host_up and
-            ts > self.ts_heartbeat + self.config['timeout_heartbeat']
+            ts >= self.ts_heartbeat + self.config['timeout_heartbeat']
         ):
             return NodeFailure.TIMEOUT_HEARTBEAT
         if (
             self.host_up and not self.genesis and
-            ts > self.ts_start + self.config['timeout_start_rnode']
+            ts >= self.ts_start + self.config['timeout_start_rnode']
         ):
             return NodeFailure.TIMEOUT_START_RNODE
         if (
             not self.host_up and
-            ts > self.ts_start + self.config['timeout_start_host']
+            ts >= self.ts_start + self.config['timeout_start_host']
         ):
             return NodeFailure.TIMEOUT_START_HOST
         return None
 
+    def _check_host(self):
+        if self.host_up and self.host.is_down():
+            return NodeFailure.HOST_DOWN
+        return None
+
     def check_failure(self, ts):
-        if self.maintenance_lock.locked():
+        if self.loading or self.maintenance_lock.locked():
             return None
         if not self.failure:
-            new_failure = self._check_timeouts(ts)
+            new_failure = self._check_timeouts(ts) or self._check_host()
             if new_failure:
                 self.log.info('Failure: %s', new_failure.name)
                 self.failure = new_failure
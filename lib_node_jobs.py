@@ -0,0 +1,156 @@
+import enum
+import logging
+import re
+import time
+import uuid
+from asyncio import create_task, gather
+from collections import Counter, OrderedDict
+
+from schema import Schema, And, Optional as Opt
+
+# Node names end up in GCE resource names and host names
+NODE_NAME = re.compile(r'^[a-z0-9]([-a-z0-9]*[a-z0-9])?$')
+
+NodeName = And(str, lambda s: NODE_NAME.match(s) is not None)
+
+JOB_SCHEMA = Schema(
+    {
+        'nodes': And(
+            [{
+                'name': NodeName,
+                Opt('config'): dict,
+            }],
+            len,
+            lambda nodes: len({n['name'] for n in nodes}) == len(nodes),
+        ),
+    }
+)
+
+JobNodeState = enum.IntEnum(
+    'JobNodeState', 'PENDING RENDERED STARTING STARTED FAILED'
+)
+
+MAX_FINISHED_JOBS = 100
+
+
+class NodeJob:
+    def __init__(self, specs):
+        self.id = uuid.uuid4().hex
+        self.specs = specs
+        self.ts_created = time.time()
+        self.ts_finished = None
+        self.states = OrderedDict(
+            (spec['name'], JobNodeState.PENDING) for spec in specs
+        )
+        self.errors = {}
+
+    def set_state(self, name, state):
+        self.states[name] = state
+
+    def fail(self, name, error):
+        self.states[name] = JobNodeState.FAILED
+        self.errors[name] = '%s: %s' % (type(error).__name__, error)
+
+    def status(self):
+        counts = Counter(state.name for state in self.states.values())
+        return {
+            'id': self.id,
+            'done': self.ts_finished is not None,
+            'ts_created': self.ts_created,
+            'ts_finished': self.ts_finished,
+            'counts': dict(counts),
+            'nodes': {
+                name: {
+                    'state': state.name,
+                    'error': self.errors.get(name),
+                }
+                for name, state in self.states.items()
+            },
+        }
+
+
+class NodeJobs:
+    def __init__(self, net_ctx):
+        self.net_ctx = net_ctx
+        self.jobs = OrderedDict()
+
+        self.log = logging.getLogger(__name__)
+
+    def submit(self, request):
+        specs = JOB_SCHEMA.validate(request)['nodes']
+        job = NodeJob(specs)
+        self.jobs[job.id] = job
+        self._expire()
+        self.log.info('Job %s: %d nodes', job.id, len(specs))
+        create_task(self._run(job))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _expire(self):
+        finished = [
+            job_id for job_id, job in self.jobs.items() if job.ts_finished
+        ]
+        for job_id in finished[:-MAX_FINISHED_JOBS]:
+            del self.jobs[job_id]
+
+    async def _render(self, job, spec):
+        name = spec['name']
+        config = spec.get('config')
+        try:
+            node = self.net_ctx.nodes.get(name)
+            if node:
+                if node.loading:
+                    raise RuntimeError('Node is being loaded')
+                await self.net_ctx.update_node(node, config)
+            else:
+                node = await self.net_ctx.create_node(
+                    name, config, start=False
+                )
+        except Exception as e:
+            job.fail(name, e)
+            return None
+        job.set_state(name, JobNodeState.RENDERED)
+        return node
+
+    async def _provision(self, job, node):
+        job.set_state(node.name, JobNodeState.STARTING)
+        try:
+            await node.try_start_async()
+        except Exception as e:
+            job.fail(node.name, e)
+            return
+        job.set_state(node.name, JobNodeState.STARTED)
+
+    async def _run(self, job):
+        ts_begin = time.time()
+        try:
+            # Nothing is provisioned until every config has been rendered
+            nodes = await gather(
+                *(self._render(job, spec) for spec in job.specs)
+            )
+            nodes = [node for node in nodes if node]
+            ts_render = time.time()
+            self.log.info(
+                'Job %s: rendered %d nodes in %.3fs', job.id, len(nodes),
+                ts_render - ts_begin
+            )
+            # One listing covers the resources of all the new nodes, so
+            # their hosts skip the per-resource lookups
+            await self.net_ctx.refresh_inventory()
+            await gather(*(self._provision(job, node) for node in nodes))
+            self.log.info(
+                'Job %s: provisioned in %.3fs', job.id,
+                time.time() - ts_render
+            )
+        except:
+            self.log.exception('Job %s failed', job.id)
+        finally:
+            job.ts_finished = time.time()
+
+    def stats(self):
+        return {
+            'active': sum(1 for j in self.jobs.values() if not j.ts_finished),
+            'kept': len(self.jobs),
+        }
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from asyncio import create_task, shield
+from pathlib import Path
+
+from lib_config_store import get_config_store
+from lib_util import run_async, try_read_json
+
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+RETRY_INTERVAL = 10
+CHUNK_SIZE = 1 << 20
+
+
+class PackageUnavailable(Exception):
+    pass
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+
+def _filename(url):
+    # Kept at the end of mirror URLs, unpacking goes by the extension
+    name = os.path.basename(urllib.parse.urlsplit(url).path)
+    return name or 'package'
+
+
+class PackageMirror:
+    def __init__(self, app_config, on_ready):
+        self.base_url = app_config.package_mirror_url
+        self.dir = Path(app_config.data_dir).resolve() / 'packages'
+        self.on_ready = on_ready
+        self._index = try_read_json(self.index_file, {})
+        self._urls = {url_key(url): url for url in self._index}
+        self._fetches = {}
+        self._retry_at = {}
+        self.fetched = 0
+        self.bytes_fetched = 0
+        self.failures = 0
+
+        self.log = logging.getLogger(__name__)
+
+    @property
+    def index_file(self) -> Path:
+        return self.dir / 'index.json'
+
+    def _cached(self, url):
+        sha256 = self._index.get(url)
+        if sha256 and SHA256.match(sha256) and (self.dir / sha256).is_file():
+            return sha256
+        return None
+
+    def resolve(self, url):
+        if not self.base_url:
+            return url, None
+        # Keyed by the upstream URL, not the content, so that hosts see
+        # the same URL before and after the mirror has its copy
+        key = url_key(url)
+        self._urls[key] = url
+        sha256 = self._cached(url)
+        if not sha256:
+            self._fetch_async(url)
+        return '%s/packages/%s/%s' % (
+            self.base_url.rstrip('/'), key, _filename(url)
+        ), sha256
+
+    def _fetch_async(self, url):
+        if url not in self._fetches:
+            if time.time() < self._retry_at.get(url, 0):
+                return None
+            self._fetches[url] = create_task(self._fetch(url))
+        return self._fetches[url]
+
+    async def get(self, key):
+        url = self._urls.get(key)
+        if not url:
+            return None
+        sha256 = self._cached(url)
+        if not sha256:
+            # Every host waits on the same upstream download
+            fetch = self._fetch_async(url)
+            if fetch:
+                await shield(fetch)
+            sha256 = self._cached(url)
+            if not sha256:
+                raise PackageUnavailable(url)
+        return self.dir / sha256, sha256
+
+    def _download(self, url):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.dir / ('.%s.tmp' % uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with urllib.request.urlopen(url, timeout=60) as response, \
+                    open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            sha256 = digest.hexdigest()
+            os.replace(tmp_path, self.dir / sha256)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return sha256, size
+
+    async def _fetch(self, url):
+        self.log.info('Fetching %s', url)
+        ts_begin = time.time()
+        try:
+            sha256, size = await run_async(self._download, url)
+            self._index[url] = sha256
+            await run_async(
+                get_config_store().write_json, self.index_file,
+                dict(self._index)
+            )
+        except:
+            self.log.exception('Failed to fetch %s', url)
+            self.failures += 1
+            self._retry_at[url] = time.time() + RETRY_INTERVAL
+            return
+        finally:
+            del self._fetches[url]
+        self._retry_at.pop(url, None)
+        self.fetched += 1
+        self.bytes_fetched += size
+        self.log.info(
+            'Fetched %s in %.1fs: %d bytes, sha256 %s', url,
+            time.time() - ts_begin, size, sha256
+        )
+        self.on_ready(url)
+
+    def retry_failed(self):
+        for url in list(self._retry_at):
+            if not self._cached(url):
+                self._fetch_async(url)
+
+    def prune(self, urls):
+        # A finished download is only indexed once its fetch resumes,
+        # until then its file would look unused
+        if self._fetches:
+            return
+        self._index = {
+            url: sha256
+            for url, sha256 in self._index.items() if url in urls
+        }
+        get_config_store().write_json(self.index_file, self._index)
+        keep = set(self._index.values())
+        for path in self.dir.iterdir():
+            if SHA256.match(path.name) and path.name not in keep:
+                self.log.info('Removing unused package %s', path.name)
+                path.unlink()
+
+    def stats(self):
+        return {
+            'packages': len(set(self._index.values())),
+            'fetching': len(self._fetches),
+            'fetched': self.fetched,
+            'bytes_fetched': self.bytes_fetched,
+            'failures': self.failures,
+        }
@@ -0,0 +1,107 @@
+import enum
+import logging
+import time
+from asyncio import Event, sleep
+from collections import OrderedDict
+
+from lib_node_ctx import NodeFailure
+
+# Ordered by strength, a queued node gets the strongest action asked for
+RestartAction = enum.IntEnum('RestartAction', 'RECONFIGURE CLEAN_DATA')
+
+
+def parse_budget(value, total):
+    if isinstance(value, str) and value.endswith('%'):
+        count = total * float(value[:-1]) // 100
+    else:
+        count = int(value)
+    return max(1, int(count))
+
+
+class RollingRestart:
+    def __init__(self, net_ctx, max_unavailable, poll_interval=1):
+        self.net_ctx = net_ctx
+        self.max_unavailable = max_unavailable
+        self.poll_interval = poll_interval
+
+        self.queue = OrderedDict()
+        self.batch = []
+        self._wakeup = Event()
+
+        self.log = logging.getLogger(__name__)
+
+    def enqueue(self, node, action):
+        if node in self.batch:
+            return
+        if node.name in self.queue:
+            action = max(action, self.queue[node.name])
+        else:
+            self.log.info('Queued %s: %s', action.name.lower(), node)
+        self.queue[node.name] = action
+        self._wakeup.set()
+
+    def is_pending(self, node, action):
+        return node in self.batch or self.queue.get(node.name, 0) >= action
+
+    def _is_settled(self, node, ts):
+        return node.name not in self.net_ctx.nodes or node.is_settled(ts)
+
+    def _expire(self, ts):
+        # A host can keep heartbeating without rnode ever coming back, it
+        # is handed to failure handling instead of holding up the queue
+        now = time.time()
+        for node in self.batch:
+            if (
+                not self._is_settled(node, ts) and
+                not node.maintenance_lock.locked() and
+                now >= max(ts, node.ts_start) +
+                node.config['timeout_start_rnode']
+            ):
+                self.log.warning('Node did not settle: %s', node)
+                node.failure = NodeFailure.TIMEOUT_START_RNODE
+
+    def _take_batch(self):
+        size = parse_budget(self.max_unavailable, len(self.net_ctx.nodes))
+        batch = []
+        while self.queue and len(batch) < size:
+            name, action = self.queue.popitem(last=False)
+            node = self.net_ctx.nodes.get(name)
+            if node and not node.loading:
+                batch.append((node, action))
+        return batch
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.queue:
+                batch = self._take_batch()
+                if not batch:
+                    continue
+                self.batch = [node for node, _ in batch]
+                ts = time.time()
+                self.log.info(
+                    'Restarting batch of %d, %d queued', len(batch),
+                    len(self.queue)
+                )
+                for node, action in batch:
+                    if action == RestartAction.CLEAN_DATA:
+                        if node != self.net_ctx.leader:
+                            # The new cookie_exec comes with the clean
+                            node.follows = self.net_ctx.leader
+                        node.soft_clean_data()
+                    elif node != self.net_ctx.leader:
+                        # Only rnode restarts, with the leader current at
+                        # the time the batch starts
+                        node.set_follows(self.net_ctx.leader)
+                while not all(self._is_settled(n, ts) for n in self.batch):
+                    await sleep(self.poll_interval)
+                    self._expire(ts)
+                self.log.info('Batch settled in %.1fs', time.time() - ts)
+                self.batch = []
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'in_flight': len(self.batch),
+        }
@@ -0,0 +1,153 @@
+import logging
+import os
+import time
+import uuid
+from asyncio import create_task
+from pathlib import Path
+
+import lib_node_ctx
+from lib_cloud_sched import CallPriority
+from lib_host import HostClean, create_host
+from lib_util import try_read_json, write_json
+
+RETRY_MIN = 60
+RETRY_MAX = 3600
+
+
+class StandbyPool:
+    def __init__(self, app_config):
+        self.app_config = app_config
+        self.size = app_config.standby_pool_size
+        self.provisioning = 0
+        self.failures = 0
+        self.ts_retry = 0
+        self._busy = set()
+
+        self.log = logging.getLogger(__name__)
+
+        self.ready = try_read_json(self.state_file, [])
+        # Names are recorded before anything is created, whatever is left
+        # here from a failure or a restart gets torn down
+        self.pending = try_read_json(self.pending_file, [])
+
+    @property
+    def data_dir(self) -> Path:
+        return Path(self.app_config.data_dir).resolve() / 'standby'
+
+    @property
+    def state_file(self) -> Path:
+        return self.data_dir / 'ready.json'
+
+    @property
+    def pending_file(self) -> Path:
+        return self.data_dir / 'pending.json'
+
+    def _save(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        write_json(self.state_file, self.ready)
+        write_json(self.pending_file, self.pending)
+
+    def _template_config(self, name):
+        ctx = lib_node_ctx.NodeContext(self.app_config, self.data_dir, name)
+        config = ctx.load_config_merged(
+            {'templates': [self.app_config.standby_template]}
+        )
+        config['resources_name'] = config['resources_name_prefix'] + name
+        return config
+
+    def _create_host(self, name):
+        config = self._template_config(name)
+        return config, create_host(
+            self.app_config, config, self.data_dir / (name + '.applied.json')
+        )
+
+    async def _provision(self, name):
+        try:
+            config, host = self._create_host(name)
+            await host.provision_standby(self.app_config.standby_warmup)
+            self.ready.append(
+                {
+                    'host_name': config['resources_name'],
+                    'data_disk_name': config['resources_name'] + '-data',
+                    'zone': config['gcp_compute_zone'],
+                    'machine_type': config['machine_type'],
+                    'data_disk_size': config['data_disk_size'],
+                    'data_disk_ssd': config['data_disk_ssd'],
+                }
+            )
+            self.pending.remove(name)
+            self._save()
+            self.failures = 0
+            self.log.info('Standby ready: %s', config['resources_name'])
+        except:
+            self.failures += 1
+            backoff = min(RETRY_MAX, RETRY_MIN * 2**(self.failures - 1))
+            self.ts_retry = time.time() + backoff
+            self.log.exception(
+                'Failed to provision standby %s, retrying in %ds', name,
+                backoff
+            )
+            await self._teardown(name)
+        finally:
+            self._busy.discard(name)
+            self.provisioning -= 1
+
+    async def _teardown(self, name):
+        self._busy.add(name)
+        try:
+            _, host = self._create_host(name)
+            await host.stop(HostClean.DATA, CallPriority.BACKGROUND)
+            (self.data_dir / (name + '.applied.json')).unlink(missing_ok=True)
+            self.pending.remove(name)
+            self._save()
+            self.log.info('Removed unfinished standby %s', name)
+        except:
+            self.log.exception('Failed to remove unfinished standby %s', name)
+        finally:
+            self._busy.discard(name)
+
+    def fill(self):
+        for name in self.pending:
+            if name not in self._busy:
+                create_task(self._teardown(name))
+        if time.time() < self.ts_retry:
+            return
+        while len(self.ready) + self.provisioning < self.size:
+            name = 'standby-' + uuid.uuid4().hex[:8]
+            self.pending.append(name)
+            self._busy.add(name)
+            self._save()
+            self.provisioning += 1
+            create_task(self._provision(name))
+
+    def take(self, node):
+        config = node.config
+        for i, standby in enumerate(self.ready):
+            if (
+                standby['zone'] == config['gcp_compute_zone'] and
+                standby['machine_type'] == config['machine_type'] and
+                # Disks can be grown when adopted, but not shrunk
+                standby.get('data_disk_size', 0) <= config['data_disk_size']
+                and standby.get('data_disk_ssd', config['data_disk_ssd']) ==
+                config['data_disk_ssd']
+            ):
+                del self.ready[i]
+                self._save()
+                self.log.info(
+                    'Standby %s taken by %s', standby['host_name'], node.name
+                )
+                return standby
+        return None
+
+    def release(self, standby):
+        self.log.info('Standby %s returned', standby['host_name'])
+        self.ready.append(standby)
+        self._save()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'ready': len(self.ready),
+            'provisioning': self.provisioning,
+            'failures': self.failures,
+        }
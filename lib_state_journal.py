@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+from lib_config_store import get_config_store
+from lib_util import try_read_json
+
+
+class StateJournal:
+    def __init__(self, data_dir):
+        self.dir = Path(data_dir).resolve() / 'state'
+        self.seq = 0
+        self._journal = None
+
+        self.log = logging.getLogger(__name__)
+
+    @property
+    def snapshot_file(self) -> Path:
+        return self.dir / 'snapshot.json'
+
+    @property
+    def journal_file(self) -> Path:
+        return self.dir / 'journal.jsonl'
+
+    def load(self):
+        try:
+            snapshot = try_read_json(self.snapshot_file, {})
+        except ValueError:
+            # Same as a missing snapshot, the journal is still replayed and
+            # everything else is reported in again by the hosts
+            self.log.exception('Ignoring unreadable snapshot')
+            snapshot = {}
+        nodes = snapshot.get('nodes', {})
+        leader = snapshot.get('leader')
+        self.seq = snapshot.get('seq', 0)
+        try:
+            with open(self.journal_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self.log.warning('Ignoring torn journal entry')
+                        break
+                    # Left over from before the snapshot was taken
+                    if entry['seq'] <= self.seq:
+                        continue
+                    self.seq = entry['seq']
+                    if 'node' in entry:
+                        nodes[entry['node']] = entry['state']
+                    else:
+                        leader = entry['leader']
+        except FileNotFoundError:
+            pass
+        return nodes, leader
+
+    def _append(self, entry):
+        if not self._journal:
+            os.makedirs(self.dir, exist_ok=True)
+            self._journal = open(self.journal_file, 'a')
+        self.seq += 1
+        entry['seq'] = self.seq
+        self._journal.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._journal.flush()
+
+    def record_node(self, name, state):
+        self._append({'node': name, 'state': state})
+
+    def record_leader(self, name):
+        self._append({'leader': name})
+
+    def snapshot(self, nodes, leader):
+        os.makedirs(self.dir, exist_ok=True)
+        # Written atomically, the journal is only truncated once the
+        # snapshot is durable
+        get_config_store().write_json(
+            self.snapshot_file, {
+                'seq': self.seq,
+                'nodes': nodes,
+                'leader': leader
+            }
+        )
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self.journal_file, 'w')
@@ -0,0 +1,87 @@
+import copy
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from lib_util import read_json, resolve_path
+
+
+class TemplateCache:
+    def __init__(self, templates_dir):
+        self.templates_dir = templates_dir
+        self._templates = {}
+        self._stats = {}
+        self._dependents = defaultdict(set)
+        self._lock = threading.Lock()
+
+        self.log = logging.getLogger(__name__)
+
+    def _stat(self, name):
+        try:
+            st = os.stat(resolve_path(self.templates_dir, name + '.json'))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, name):
+        stat = self._stat(name)
+        with self._lock:
+            cached = self._templates.get(name)
+        if not cached or cached[0] != stat:
+            path = resolve_path(self.templates_dir, name + '.json')
+            cached = (stat, read_json(path))
+            with self._lock:
+                self._templates[name] = cached
+        # Merging keeps references into its inputs, so the cached copy
+        # must never be handed out
+        return copy.deepcopy(cached[1])
+
+    def set_dependencies(self, node_name, names):
+        names = set(names)
+        # Baseline for changed(), also for templates never parsed here
+        stats = {
+            name: self._stat(name)
+            for name in names if name not in self._stats
+        }
+        with self._lock:
+            for name, stat in stats.items():
+                self._stats.setdefault(name, stat)
+            for dependents in self._dependents.values():
+                dependents.discard(node_name)
+            for name in names:
+                self._dependents[name].add(node_name)
+
+    def dependents(self, names):
+        with self._lock:
+            return set().union(*(self._dependents[n] for n in names))
+
+    def changed(self):
+        changed = []
+        with self._lock:
+            stats = list(self._stats.items())
+        for name, stat in stats:
+            new_stat = self._stat(name)
+            if new_stat == stat:
+                continue
+            self.log.info('Template changed: %s', name)
+            with self._lock:
+                self._stats[name] = new_stat
+            changed.append(name)
+        return changed
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_template_cache(app_config):
+    # First used from the node load threads
+    templates_dir = app_config.node_config_templates_dir
+    with _caches_lock:
+        try:
+            return _caches[templates_dir]
+        except KeyError:
+            cache = TemplateCache(templates_dir)
+            _caches[templates_dir] = cache
+            return cache
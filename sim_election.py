@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+# Leader election simulator. Drives NetworkContext and NodeContext on a
+# virtual clock: the event loop jumps straight to the next timer instead
+# of sleeping, so an hour of network time takes a fraction of a second
+# and a given seed always gives the same run. Hosts are HostFake
+# instances that also play the rnode side of the heartbeat protocol.
+#
+#   ./sim_election.py --scenario rogue-genesis --nodes 50
+#   ./sim_election.py --scenario my-scenario.json --check-interval 30
+#
+# A scenario is a list of events applied at virtual times (seconds):
+#
+#   {"at": 0, "genesis": "B", "fraction": 0.3}  nodes move to genesis B
+#   {"at": 300, "kill": "leader"}              the leader's host dies
+#   {"at": 300, "kill": 0.1}                   10% of the hosts die
+#   {"at": 300, "stall": 0.2, "for": 60}       heartbeats stop for 60s
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import selectors
+import shutil
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import lib_app_config
+import lib_net_ctx
+import lib_node_ctx
+from lib_host import HostClean
+from lib_host_fake import HostFake
+from lib_util import read_json
+
+TEMPLATE = Path(__file__).resolve().parent / 'data/templates/default.json'
+
+PRESETS = {
+    'rogue-genesis': [
+        {'at': 0, 'genesis': 'B', 'fraction': 0.3},
+    ],
+    'leader-loss': [
+        {'at': 600, 'kill': 'leader'},
+    ],
+    'leader-dies-during-restarts': [
+        {'at': 0, 'genesis': 'B', 'fraction': 0.3},
+        {'at': 75, 'kill': 'leader'},
+    ],
+    'heartbeat-stall': [
+        {'at': 600, 'stall': 0.2, 'for': 60},
+    ],
+}
+
+
+class VirtualClock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing scheduled, only threads or sockets can wake us up
+            return super().select(None)
+        self.clock.now += timeout
+        return events
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualSelector(clock))
+        self.clock = clock
+        # Timestamps around 1e9 are only precise to ~1e-7, timers due
+        # "now" would never fire with the default nanosecond resolution
+        self._clock_resolution = 1e-6
+
+    def time(self):
+        return self.clock.now
+
+
+class SimHost(HostFake):
+    def __init__(self, sim, node, genesis):
+        super().__init__(node.config, sim.args.host_latency)
+        self.sim = sim
+        self.node = node
+        self.genesis = genesis
+        self.cookie_exec = None
+        self.cookie_data = None
+        self.rnode_ready = 0
+        self.stalled_until = 0
+        self._task = None
+
+    async def start(self, *args, **kwargs):
+        await super().start(*args, **kwargs)
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, clean=HostClean.STOP, *args, **kwargs):
+        self._halt()
+        await super().stop(clean, *args, **kwargs)
+        if clean >= HostClean.DATA:
+            self.genesis = None
+
+    def kill(self):
+        self._halt()
+        self.running = False
+
+    def _halt(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _restart_rnode(self):
+        self.rnode_ready = time.time() + self.sim.args.rnode_restart
+
+    def _apply(self, reply):
+        if not reply or reply.get('unchanged'):
+            return
+        if self.cookie_data and self.cookie_data != reply['cookie_data']:
+            self.sim.counts['data_cleans'] += 1
+            self.genesis = None
+        self.cookie_data = reply['cookie_data']
+        if self.cookie_exec != reply['cookie_exec']:
+            self._restart_rnode()
+        self.cookie_exec = reply['cookie_exec']
+        self.leader = reply.get('leader')
+
+    def _sync_genesis(self):
+        if self.genesis or time.time() < self.rnode_ready:
+            return
+        if self.leader:
+            leader = self.sim.hosts_by_addr[self.leader]
+            self.genesis = leader.genesis
+        elif time.time() >= self.rnode_ready + self.sim.args.genesis_time:
+            self.genesis = self.sim.new_genesis()
+
+    async def _run(self):
+        await asyncio.sleep(self.sim.args.boot_time)
+        self._restart_rnode()
+        while True:
+            if time.time() >= self.stalled_until:
+                self._sync_genesis()
+                msg = {
+                    'cookie_exec': str(self.cookie_exec),
+                    'cookie_data': str(self.cookie_data),
+                }
+                if self.genesis and time.time() >= self.rnode_ready:
+                    msg['genesis'] = self.genesis
+                self._apply(self.node.heartbeat(msg))
+            await asyncio.sleep(self.sim.args.heartbeat_interval)
+
+
+class Simulation:
+    def __init__(self, args, scenario):
+        self.args = args
+        self.scenario = sorted(scenario, key=lambda e: e['at'])
+        self.counts = Counter()
+        self.hosts_by_addr = {}
+        self.geneses = 0
+        self.leaders = []
+        self.log = logging.getLogger('sim')
+
+        self.root = root = Path(tempfile.mkdtemp(prefix='sim-election-'))
+        credentials = root / 'credentials.json'
+        credentials.write_text('{}')
+        self.app_config = lib_app_config.AppConfig(
+            {
+                'data_dir': str(root),
+                'gcp_credentials_file': str(credentials),
+                'host_backend': 'fake',
+                'initial_delay': args.initial_delay,
+                'check_interval': args.check_interval,
+                'decision_debounce': args.decision_debounce,
+                'restart_max_unavailable': args.max_unavailable,
+            }
+        )
+        self.net_ctx = lib_net_ctx.NetworkContext(self.app_config)
+
+    def new_genesis(self):
+        self.geneses += 1
+        return 'G%d' % self.geneses
+
+    def _create_nodes(self):
+        template = read_json(TEMPLATE)
+        for i in range(self.args.nodes):
+            name = 'node%03d' % i
+            node = lib_node_ctx.NodeContext(
+                self.app_config,
+                Path(self.app_config.nodes_data_dir) / name,
+                name,
+                self.net_ctx.genesis_index,
+                self.net_ctx.deadlines,
+            )
+            node.config = dict(
+                template,
+                resources_name=template['resources_name_prefix'] + name,
+                rnode_addr='rnode://%s' % name,
+                timeout_heartbeat=self.args.timeout_heartbeat,
+                timeout_start_rnode=self.args.timeout_start_rnode,
+                timeout_start_host=self.args.timeout_start_host,
+            )
+            node.gen_cookie_exec()
+            node.host = SimHost(self, node, 'A')
+            node.loading = False
+            self.net_ctx.nodes[name] = node
+            self.hosts_by_addr[node.config['rnode_addr']] = node.host
+
+    def _pick(self, fraction):
+        nodes = list(self.net_ctx.nodes.values())
+        return random.sample(nodes, max(1, round(len(nodes) * fraction)))
+
+    def _apply(self, event):
+        self.log.warning('Event: %s', event)
+        if 'genesis' in event:
+            for node in self._pick(event['fraction']):
+                node.host.genesis = event['genesis']
+        if 'kill' in event:
+            if event['kill'] == 'leader':
+                nodes = [self.net_ctx.leader] if self.net_ctx.leader else []
+            else:
+                nodes = self._pick(event['kill'])
+            for node in nodes:
+                node.host.kill()
+        if 'stall' in event:
+            for node in self._pick(event['stall']):
+                node.host.stalled_until = time.time() + event['for']
+
+    def converged(self):
+        # Judged by what the hosts actually run, not by what the controller
+        # believes, which lags behind after a failure
+        leader = self.net_ctx.leader
+        groups = self.net_ctx.genesis_index.groups
+        if not leader or len(groups) != 1:
+            return False
+        now = time.time()
+        for node in self.net_ctx.nodes.values():
+            host = node.host
+            if (
+                not host.running or host.stalled_until > now or
+                host.genesis != leader.host.genesis or
+                node.genesis != host.genesis or
+                node != leader and node.follows != leader
+            ):
+                return False
+        return True
+
+    async def _supervise(self):
+        ts_begin = time.time()
+        ts_converged = None
+        events = list(self.scenario)
+        while events and events[0]['at'] <= 0:
+            self._apply(events.pop(0))
+
+        while time.time() - ts_begin < self.args.duration:
+            now = time.time() - ts_begin
+            if events and events[0]['at'] <= now:
+                while events and events[0]['at'] <= now:
+                    self._apply(events.pop(0))
+                ts_converged = None
+                await asyncio.sleep(1)
+                continue
+            if self.net_ctx.leader is not (
+                self.leaders[-1] if self.leaders else None
+            ):
+                self.leaders.append(self.net_ctx.leader)
+            if self.converged():
+                if ts_converged is None:
+                    ts_converged = now
+                if not events:
+                    break
+            else:
+                ts_converged = None
+            await asyncio.sleep(1)
+
+        hosts = [node.host for node in self.net_ctx.nodes.values()]
+        calls = sum((host.calls for host in hosts), Counter())
+        last_event = self.scenario[-1]['at'] if self.scenario else 0
+        return {
+            'converged_at': ts_converged,
+            'convergence_time': (
+                ts_converged - max(0, last_event)
+                if ts_converged is not None else None
+            ),
+            'leader_changes': len(self.leaders),
+            'restarts': calls['stop'],
+            'data_cleans': self.counts['data_cleans'],
+            'cloud_calls': sum(calls.values()),
+            'cloud_calls_by_op': dict(calls),
+            'genesis_groups': self.net_ctx.genesis_index.sizes(),
+        }
+
+    async def run(self):
+        self._create_nodes()
+        for node in self.net_ctx.nodes.values():
+            node.try_start_async()
+        asyncio.create_task(self.net_ctx.restarts.run())
+        supervisor = asyncio.create_task(self._supervise())
+        await asyncio.sleep(self.app_config.initial_delay)
+        self.net_ctx.decisions_enabled = True
+        main_loop = asyncio.create_task(self.net_ctx.main_loop())
+        report = await supervisor
+        main_loop.cancel()
+        shutil.rmtree(self.root)
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--scenario',
+        default='rogue-genesis',
+        help='preset (%s) or JSON file' % ', '.join(PRESETS),
+    )
+    parser.add_argument('--nodes', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=3600)
+    parser.add_argument('--initial-delay', type=int, default=60)
+    parser.add_argument('--check-interval', type=int, default=120)
+    parser.add_argument('--decision-debounce', type=float, default=1)
+    parser.add_argument('--max-unavailable', default='10%')
+    parser.add_argument('--timeout-heartbeat', type=float, default=30)
+    parser.add_argument('--timeout-start-rnode', type=float, default=120)
+    parser.add_argument('--timeout-start-host', type=float, default=300)
+    parser.add_argument('--heartbeat-interval', type=float, default=5)
+    parser.add_argument('--host-latency', type=float, default=20)
+    parser.add_argument('--boot-time', type=float, default=40)
+    parser.add_argument('--rnode-restart', type=float, default=15)
+    parser.add_argument('--genesis-time', type=float, default=30)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.ERROR,
+        format='%(created)14.1f %(levelname)8s %(name)s %(message)s'
+    )
+    if args.scenario in PRESETS:
+        scenario = PRESETS[args.scenario]
+    else:
+        scenario = read_json(args.scenario)
+
+    random.seed(args.seed)
+    clock = VirtualClock(1e9)
+    time.time = clock.time
+    loop = VirtualEventLoop(clock)
+    asyncio.set_event_loop(loop)
+    try:
+        report = loop.run_until_complete(Simulation(args, scenario).run())
+        # Whatever is still in flight is cut short, not a failure
+        logging.disable(logging.CRITICAL)
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True)
+        )
+    finally:
+        loop.close()
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()